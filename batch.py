@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# batch.py
+#
+# Run a file of objectives through natbot without a human in the loop:
+#
+#   python batch.py objectives.jsonl -o results.jsonl --workers 16 --browsers 2
+#
+# Each input line is a JSON object with an "objective" and optionally "id", "url", "max_steps" and "timeout".
+# Step traces and per-task results are streamed to the output file as JSON lines while the batch runs.
+#
+
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from compaction import compact
+from commands import Click, CommandParseError, Scroll, Type, format_command, parse_command
+from natbot import (
+    browser_content_budget, compiled_plan_prompt, compiled_prompt, get_gpt_command, parse_plan, remap_command,
+    settle_action,
+)
+from pool import BrowserPool
+from replay import Recorder
+from resources import AssetCache, ResourcePolicy, read_domains
+from tracing import tracer
+
+# seconds between prefetches while the model thinks or the page settles, and how long the DOM has to stay unchanged
+# before one captures
+prefetch_interval = 0.2
+
+
+async def perform(crawler, action):
+    # performs action without waiting for the page, returning the settle policy to use
+    with tracer.span("action", command=format_command(action)):
+        if isinstance(action, Scroll):
+            await crawler.scroll(action.direction)
+        elif isinstance(action, Click):
+            await crawler.click(action.id)
+        elif isinstance(action, Type):
+            await crawler.type(action.id, action.text + "\n" if action.submit else action.text)
+
+    return settle_action(action)
+
+
+async def refresh_until(crawler, pending):
+    # Keep the cached snapshot current until `pending` finishes, so the crawl after it is usually just a cull.
+    # prefetch only captures once the DOM has not changed for a whole interval, so a page that keeps mutating while
+    # it settles is captured once it calms down instead of on every poll.
+    while not pending.done():
+        await crawler.prefetch()
+        await asyncio.wait([pending], timeout=prefetch_interval)
+
+
+async def run_objective(crawler, task, max_steps, emit, pipeline=False, plan=False, full_page=False, record_dir=None,
+                        extractor="snapshot"):
+    # With pipeline, the snapshot is refreshed while the model is thinking and re-captured while the page settles,
+    # so a step costs roughly max(crawl, model) instead of crawl + model. With plan, the model may answer with a few
+    # commands, which run back to back for as long as their elements are still on the page.
+    objective = task["objective"]
+    template = compiled_plan_prompt if plan else compiled_prompt
+    crawler.full_page = full_page
+    crawler.extractor = extractor
+    crawler.recorder = Recorder(record_dir, prefix=f"{task['id']}-") if record_dir else None
+    await crawler.go_to_page(task.get("url", "google.com"))
+
+    prev_cmd = ""
+    for step in range(max_steps):
+        step_start = time.time()
+        spans = {}
+
+        async def timed(stage, awaitable):
+            start = time.time()
+            try:
+                return await awaitable
+            finally:
+                spans[stage] = [start - step_start, time.time() - step_start]
+
+        browser_content = "\n".join(compact(await timed("crawl", crawler.crawl()), browser_content_budget))
+        crawl_timings = crawler.timings
+
+        model_call = asyncio.ensure_future(timed("model", asyncio.to_thread(
+            get_gpt_command, objective, crawler.page.url, prev_cmd, browser_content, plan
+        )))
+        if pipeline:
+            await timed("prefetch", refresh_until(crawler, model_call))
+        gpt_cmd, model_metrics = await model_call
+        gpt_cmd = gpt_cmd.strip()
+
+        # get_gpt_command already re-asked for answers that do not parse, so one that still does not is skipped
+        try:
+            actions = parse_plan(gpt_cmd) if plan else [parse_command(gpt_cmd)]
+        except CommandParseError:
+            actions = []
+        planned_elements = dict(crawler.page_element_buffer)
+        executed = []
+        for position, action in enumerate(actions):
+            # later commands of a plan get their own stages: crawl_1, action_1, settle_1...
+            suffix = f"_{position}" if position else ""
+            if position:
+                await timed("crawl" + suffix, crawler.crawl())
+                action = remap_command(action, planned_elements, crawler.page_element_buffer)
+                if action is None:
+                    break
+
+            policy = await timed("action" + suffix, perform(crawler, action))
+            executed.append(format_command(action))
+
+            settle = asyncio.ensure_future(timed("settle" + suffix, crawler.settle(policy)))
+            if pipeline:
+                await timed("recrawl" + suffix, refresh_until(crawler, settle))
+            await settle
+        prev_cmd = executed[-1] if executed else gpt_cmd
+
+        record = {
+            "type": "step",
+            "id": task["id"],
+            "step": step,
+            "url": crawler.page.url,
+            "command": gpt_cmd,
+            "model": model_metrics,
+            "prompt": {
+                "prefix_tokens": template.prefix_tokens,
+                "cached_tokens": model_metrics.get("cached_tokens"),
+            },
+            "wall": time.time() - step_start,
+            "timings": {
+                **{stage: end - start for stage, (start, end) in spans.items()},
+                **{f"crawl_{phase}": seconds for phase, seconds in crawl_timings.items()},
+            },
+            "spans": spans,
+        }
+        if crawler.resources is not None:
+            record["resources"] = dict(crawler.resource_stats)
+        if plan:
+            record.update(plan=[format_command(action) for action in actions], executed=executed)
+        emit(record)
+
+        if not gpt_cmd:
+            return "no_command", step + 1
+
+    return "max_steps", max_steps
+
+
+async def run_task(pool, task, max_steps, timeout, emit, pipeline=False, plan=False, full_page=False,
+                   record_dir=None, extractor="snapshot"):
+    start = time.time()
+    result = {"type": "result", "id": task["id"], "objective": task["objective"]}
+
+    try:
+        async with pool.lease() as crawler:
+            status, steps = await asyncio.wait_for(
+                run_objective(
+                    crawler, task, task.get("max_steps", max_steps), emit, pipeline, plan, full_page, record_dir,
+                    extractor,
+                ),
+                task.get("timeout", timeout),
+            )
+            result.update(status=status, steps=steps, url=crawler.page.url)
+    except asyncio.TimeoutError:
+        result.update(status="timeout")
+    except Exception as e:
+        result.update(status="error", error=repr(e))
+
+    result["elapsed"] = time.time() - start
+    emit(result)
+    return result
+
+
+def read_tasks(path):
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            if line.strip():
+                task = json.loads(line)
+                task.setdefault("id", line_number)
+                yield task
+
+
+async def run_batch(objectives_path, output_path, workers, browsers, max_steps, timeout, headless=True,
+                    pipeline=False, plan=False, full_page=False, record_dir=None, extractor="snapshot", resources=None):
+    # model calls are blocking, give every worker its own thread for them, and one more for flattening the snapshots
+    # AsyncCrawler captures (which then never waits for a model call to finish)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=2 * workers))
+    tasks = read_tasks(objectives_path)
+    statuses = {}
+
+    async with BrowserPool(size=browsers, headless=headless, resources=resources) as pool:
+        with open(output_path, "w") as output:
+            def emit(record):
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+
+            async def worker():
+                for task in tasks:
+                    result = await run_task(
+                        pool, task, max_steps, timeout, emit, pipeline, plan, full_page, record_dir, extractor
+                    )
+                    statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+
+            await asyncio.gather(*(worker() for _ in range(workers)))
+
+    return statuses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run natbot objectives in batch")
+    parser.add_argument("objectives", help="JSONL file of objectives")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file for step traces and results")
+    parser.add_argument("--workers", type=int, default=8, help="objectives run concurrently")
+    parser.add_argument("--browsers", type=int, default=2, help="browser processes shared by the workers")
+    parser.add_argument("--max-steps", type=int, default=10, help="per-task step limit")
+    parser.add_argument("--timeout", type=float, default=300, help="per-task timeout in seconds")
+    parser.add_argument("--headful", action="store_true", help="show the browser windows")
+    parser.add_argument("--pipeline", action="store_true", help="overlap crawling with inference and settling")
+    parser.add_argument("--plan", action="store_true", help="let the model issue several commands per call")
+    parser.add_argument("--full-page", action="store_true", help="show the model the whole page, not just the window")
+    parser.add_argument(
+        "--extractor", choices=["snapshot", "js"], default="snapshot",
+        help="filter a transferred DOMSnapshot here (snapshot) or filter in the page (js)",
+    )
+    parser.add_argument(
+        "--block-types", default="",
+        help="comma-separated resource types not to load, e.g. image,media,font (see resources.py)",
+    )
+    parser.add_argument("--block-domains", help="file of domains not to load from, one per line")
+    parser.add_argument("--asset-cache", help="SQLite file to cache static assets in, shared by all browsers")
+    parser.add_argument("--record", help="directory to save every crawl in as a fixture for replay.py")
+    parser.add_argument("--trace", help="write spans and counters here: JSON lines for .jsonl, else a Chrome trace")
+    args = parser.parse_args()
+
+    resources = None
+    if args.block_types or args.block_domains or args.asset_cache:
+        resources = ResourcePolicy(
+            block_types=[type for type in args.block_types.split(",") if type],
+            block_domains=read_domains(args.block_domains) if args.block_domains else (),
+            cache=AssetCache(args.asset_cache) if args.asset_cache else None,
+        )
+
+    start = time.time()
+    statuses = asyncio.run(run_batch(
+        args.objectives, args.output, args.workers, args.browsers, args.max_steps, args.timeout, not args.headful,
+        args.pipeline, args.plan, args.full_page, args.record, args.extractor, resources,
+    ))
+    print("Finished {} tasks in {:0.1f} seconds: {}".format(sum(statuses.values()), time.time() - start, statuses))
+    if args.trace:
+        tracer.export(args.trace)
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+#
+# bench.py
+#
+# Offline micro-benchmarks and fuzzing for the snapshot pipeline and the command parser. No browser needed.
+#
+#   python bench.py ancestry --depth 200000
+#   python bench.py commands --corpus results.jsonl
+#   python bench.py fuzz-commands --corpus results.jsonl --iterations 100000
+#   python bench.py tracing
+#   python bench.py crawl --nodes 10000 50000 200000 --golden golden
+#
+# A corpus is a batch.py output file (the raw model answers of its step records) or a text file of answers, one per
+# line; the answers below are always included.
+#
+
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from commands import CommandParseError, format_command, parse_command
+from replay import check_golden, golden_record, measure, replay
+from snapshot import nearest_ancestors
+from tracing import Tracer
+
+# model answers as they came back, including the misformats the parser has to recover from
+recorded_outputs = [
+    ' CLICK 24\n',
+    ' TYPESUBMIT 7 "search query"\n',
+    ' TYPESUBMIT 8 "anchovies"',
+    ' TYPE 14 "bistro vida menlo park"\nCLICK 18',
+    ' SCROLL DOWN\n\n',
+    ' SCROLL UP',
+    ' CLICK 12, the first search result',
+    ' click 5',
+    ' Command: CLICK 31',
+    ' 1. TYPESUBMIT 3 "2 people 7pm"',
+    ' `CLICK 9`',
+    ' TYPE_SUBMIT 6 “dentist near me”',
+    ' TYPESUBMIT 6 "dentist near me".',
+    ' TYPE id=4 "jane@example.com"',
+    ' CLICK [17]',
+    ' TYPE 11 Menlo Park',
+    ' - SCROLL down',
+    ' CLICK',
+    ' SCROLL',
+    ' I would click on the reservation link',
+    ' ',
+]
+
+
+def deep_tree(depth, anchor_every, button_every, shuffle, seed=0):
+    # a single chain of `depth` nodes with anchors and buttons sprinkled along it; optionally renumbered at random
+    # so that parents no longer precede their children
+    parent = np.arange(-1, depth - 1, dtype=np.int64)
+    marks = np.zeros((2, depth), dtype=bool)
+    marks[0, ::anchor_every] = True
+    marks[1, ::button_every] = True
+    marks[:, 0] = False
+
+    if shuffle:
+        order = np.random.default_rng(seed).permutation(depth)
+        renumbered = np.empty(depth, dtype=np.int64)
+        renumbered[order] = np.arange(depth)
+        shuffled_parent = np.full(depth, -1, dtype=np.int64)
+        has_parent = parent >= 0
+        shuffled_parent[renumbered[has_parent]] = renumbered[parent[has_parent]]
+        shuffled_marks = np.zeros_like(marks)
+        shuffled_marks[:, renumbered] = marks
+        return shuffled_parent, shuffled_marks
+
+    return parent, marks
+
+
+def walk_ancestors(parent, marks, node):
+    while node >= 0:
+        if marks[node]:
+            return node
+        node = parent[node]
+    return -1
+
+
+def bench_ancestry(args):
+    for shuffle in (False, True):
+        parent, marks = deep_tree(args.depth, args.anchor_every, args.button_every, shuffle)
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            nearest = nearest_ancestors(parent, marks)
+            timings.append(time.perf_counter() - start)
+
+        sample = random.Random(0).sample(range(args.depth), min(args.depth, 200))
+        for row in range(2):
+            for node in sample:
+                assert nearest[row, node] == walk_ancestors(parent, marks[row], node)
+
+        print(
+            "ancestry depth={} shuffled={}: best {:0.4f}s, {:0.1f}M nodes/s".format(
+                args.depth, shuffle, min(timings), args.depth / min(timings) / 1e6
+            )
+        )
+
+
+def read_corpus(path):
+    outputs = list(recorded_outputs)
+    if path is None:
+        return outputs
+
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                outputs.append(line.rstrip("\n"))
+                continue
+            if isinstance(record, dict) and record.get("type") == "step":
+                outputs.append(record.get("model", {}).get("answer", record.get("command", "")))
+    return outputs
+
+
+def parse_or_none(text):
+    try:
+        return parse_command(text)
+    except CommandParseError:
+        return None
+
+
+# rewrites a model might plausibly make that must not change what a command means
+def shout(text):
+    keyword, _, rest = text.strip().partition(" ")
+    return keyword.upper() + " " + rest
+
+
+def whisper(text):
+    keyword, _, rest = text.strip().partition(" ")
+    return keyword.lower() + " " + rest
+
+
+harmless_mutations = [
+    lambda text: "  " + text + "  ",
+    lambda text: "1. " + text,
+    lambda text: "- " + text,
+    lambda text: "Command: " + text,
+    lambda text: "`" + text.strip() + "`",
+    lambda text: text + "\nThis should take us to the results.",
+    shout,
+    whisper,
+]
+
+
+def damage(text, rng):
+    # an arbitrary edit: a character deleted, inserted or replaced, or the answer cut short
+    if not text:
+        return rng.choice("CSTU\"' 0123456789")
+    position = rng.randrange(len(text))
+    edit = rng.randrange(4)
+    if edit == 0:
+        return text[:position] + text[position + 1:]
+    if edit == 1:
+        return text[:position] + rng.choice("CSTU\"'“” ,.:#[]=_-\n0123456789") + text[position:]
+    if edit == 2:
+        return text[:position] + chr(rng.randrange(32, 0x2030)) + text[position + 1:]
+    return text[:position]
+
+
+def bench_commands(args):
+    corpus = read_corpus(args.corpus)
+    parsed = sum(parse_or_none(text) is not None for text in corpus)
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            try:
+                parse_command(text)
+            except CommandParseError:
+                pass
+        timings.append(time.perf_counter() - start)
+
+    print(
+        "commands corpus={} parsed={} rejected={}: best {:0.4f}s, {:0.2f}us per answer".format(
+            len(corpus), parsed, len(corpus) - parsed, min(timings), min(timings) / len(corpus) * 1e6
+        )
+    )
+
+
+def fuzz_commands(args):
+    # Checks, on mutations of the corpus, that the parser only ever returns an action or raises CommandParseError,
+    # that harmless rewrites parse to the same action, and that every action survives format_command unchanged.
+    rng = random.Random(args.seed)
+    corpus = read_corpus(args.corpus)
+    valid = [text for text in corpus if parse_or_none(text) is not None]
+    failures = 0
+
+    for iteration in range(args.iterations):
+        text = rng.choice(corpus)
+        if valid and iteration % 2 == 0:
+            text = rng.choice(valid)
+            mutated = rng.choice(harmless_mutations)(text)
+            expected = parse_or_none(text)
+        else:
+            mutated = text
+            for _ in range(rng.randint(1, 3)):
+                mutated = damage(mutated, rng)
+            expected = None
+
+        try:
+            action = parse_or_none(mutated)
+            if expected is not None and action != expected:
+                raise AssertionError(f"parsed as {action}, expected {expected}")
+            if action is not None and parse_command(format_command(action)) != action:
+                raise AssertionError(f"{action} does not survive formatting")
+        except Exception as e:
+            failures += 1
+            if failures <= 10:
+                print(f"{mutated!r}: {e!r}")
+
+    print("fuzz-commands iterations={} seed={}: {} failures".format(args.iterations, args.seed, failures))
+    if failures:
+        raise SystemExit(1)
+
+
+def synthetic_tree(nodes, shape="wide", seed=0, width=1280):
+    # A captureSnapshot payload of `nodes` nodes laid out top to bottom, 20 nodes per 100px, with the columns and
+    # shapes Chrome sends for crawler.capture_snapshot_params. shape picks the structure: "wide" (shallow and bushy),
+    # "deep" (nesting thousands of levels deep) or "anchors" (half of the elements are links).
+    rng = random.Random(seed)
+    strings = []
+    string_ids = {}
+
+    def string(value):
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    height = nodes * 5
+    names = [string("#document"), string("HTML"), string("BODY")]
+    node_types = [9, 1, 1]
+    parent = [-1, 0, 1]
+    values = [-1, -1, -1]
+    attributes = [[], [], []]
+    layout_index = [1, 2]
+    bounds = [[0, 0, width, height], [0, 0, width, height]]
+    input_index, input_value, text_index, text_value, checked, clickable = [], [], [], [], [], []
+
+    containers = [2]
+    tags = ["DIV", "SPAN", "P", "LI", "BUTTON", "INPUT", "TEXTAREA", "IMG", "SCRIPT"]
+    anchor_share = 0.5 if shape == "anchors" else 0.08
+    for index in range(3, nodes):
+        if shape == "deep":
+            container = containers[-1] if rng.random() < 0.95 else rng.choice(containers)
+        else:
+            container = containers[max(0, len(containers) - 1 - int(rng.expovariate(0.2)))]
+        parent.append(container)
+
+        if rng.random() < 0.35:
+            names.append(string("#text"))
+            node_types.append(3)
+            values.append(string(rng.choice(["Home", "Search", "Next", "|", "item {}".format(rng.randrange(500))])))
+            attributes.append([])
+        else:
+            tag = "A" if rng.random() < anchor_share else rng.choice(tags)
+            names.append(string(tag))
+            node_types.append(1)
+            values.append(-1)
+            attributes.append([string("title"), string("label {}".format(rng.randrange(100)))] if rng.random() < 0.2
+                              else [])
+            if tag == "INPUT":
+                input_type = rng.choice(["text", "submit", "checkbox"])
+                attributes[-1] += [string("type"), string(input_type)]
+                input_index.append(index)
+                input_value.append(string("on" if input_type == "checkbox" else "value {}".format(rng.randrange(100))))
+                if input_type == "checkbox" and rng.random() < 0.5:
+                    checked.append(index)
+            elif tag == "TEXTAREA":
+                text_index.append(index)
+                text_value.append(string("text {}".format(rng.randrange(100))))
+            elif tag != "IMG":
+                containers.append(index)
+            if rng.random() < 0.05:
+                clickable.append(index)
+
+        y = index * height / nodes
+        layout_index.append(index)
+        bounds.append([rng.uniform(0, width - 200), y, rng.uniform(10, 200), rng.uniform(10, 40)])
+
+    static = string("static")
+    return {
+        "strings": strings,
+        "documents": [{
+            "nodes": {
+                "parentIndex": parent,
+                "nodeType": node_types,
+                "nodeName": names,
+                "nodeValue": values,
+                "backendNodeId": list(range(1, nodes + 1)),
+                "attributes": attributes,
+                "textValue": {"index": text_index, "value": text_value},
+                "inputValue": {"index": input_index, "value": input_value},
+                "inputChecked": {"index": checked},
+                "isClickable": {"index": clickable},
+            },
+            "layout": {
+                "nodeIndex": layout_index,
+                "styles": [[static]] * len(layout_index),
+                "bounds": bounds,
+                "text": [-1] * len(layout_index),
+                "stackingContexts": {"index": [0]},
+                "paintOrders": list(range(len(layout_index))),
+            },
+            "scrollOffsetX": 0,
+            "scrollOffsetY": 0,
+        }],
+    }
+
+
+def bench_crawl(args):
+    # the crawl pipeline (flattening, culling, rendering) on synthetic pages, as replay.py runs it on fixtures
+    viewport_state = {
+        "device_pixel_ratio": 1, "page_x_offset": 0, "page_y_offset": args.scroll, "screen_width": 1280,
+        "screen_height": 1080,
+    }
+    if args.golden:
+        os.makedirs(args.golden, exist_ok=True)
+
+    mismatches = 0
+    for shape in args.shapes:
+        for nodes in args.nodes:
+            fixture = {
+                "viewport_state": viewport_state,
+                "full_page": args.full_page,
+                "platform": "linux",
+                "snapshot": synthetic_tree(nodes, shape, args.seed),
+            }
+            seconds, peak, (elements, page_element_buffer) = measure(lambda: replay(fixture), args.repeat)
+
+            status = ""
+            if args.golden:
+                name = "crawl-{}-{}{}.golden.json".format(shape, nodes, "-full" if args.full_page else "")
+                status = check_golden(
+                    os.path.join(args.golden, name), golden_record(elements, page_element_buffer), args.update
+                )
+                mismatches += status == "MISMATCH"
+
+            print("crawl shape={} nodes={}: {} elements, best {:0.4f}s, {:0.2f}M nodes/s, peak {:0.1f}MB {}".format(
+                shape, nodes, len(elements), seconds, nodes / seconds / 1e6, peak / 2 ** 20, status
+            ))
+
+    if mismatches:
+        raise SystemExit(1)
+
+
+def bench_tracing(args):
+    # what a span and a counter cost, on and off; a crawl records about a dozen events
+    for enabled in (True, False):
+        tracer = Tracer(enabled=enabled, max_events=args.iterations)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            with tracer.span("bench", attribute=1) as span:
+                span.set(other=2)
+        span_cost = (time.perf_counter() - start) / args.iterations
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            tracer.count("bench", 1)
+        count_cost = (time.perf_counter() - start) / args.iterations
+
+        print("tracing enabled={}: {:0.2f}us per span, {:0.2f}us per counter".format(
+            enabled, span_cost * 1e6, count_cost * 1e6
+        ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="natbot offline benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    ancestry = subparsers.add_parser("ancestry", help="nearest anchor/button ancestors on deep synthetic trees")
+    ancestry.add_argument("--depth", type=int, default=100000)
+    ancestry.add_argument("--anchor-every", type=int, default=997)
+    ancestry.add_argument("--button-every", type=int, default=1499)
+    ancestry.add_argument("--repeat", type=int, default=5)
+    ancestry.set_defaults(run=bench_ancestry)
+
+    commands = subparsers.add_parser("commands", help="command parser throughput on recorded model answers")
+    commands.add_argument("--corpus", help="batch.py results or a file of answers, one per line")
+    commands.add_argument("--repeat", type=int, default=200)
+    commands.set_defaults(run=bench_commands)
+
+    fuzz = subparsers.add_parser("fuzz-commands", help="fuzz the command parser with mutated model answers")
+    fuzz.add_argument("--corpus", help="batch.py results or a file of answers, one per line")
+    fuzz.add_argument("--iterations", type=int, default=20000)
+    fuzz.add_argument("--seed", type=int, default=0)
+    fuzz.set_defaults(run=fuzz_commands)
+
+    crawl = subparsers.add_parser("crawl", help="flatten, cull and render synthetic pages")
+    crawl.add_argument("--nodes", type=int, nargs="+", default=[10000, 50000, 200000])
+    crawl.add_argument("--shapes", nargs="+", choices=["wide", "deep", "anchors"], default=["wide", "deep", "anchors"])
+    crawl.add_argument("--scroll", type=int, default=0, help="page_y_offset of the viewport")
+    crawl.add_argument("--full-page", action="store_true")
+    crawl.add_argument("--seed", type=int, default=0)
+    crawl.add_argument("--repeat", type=int, default=3)
+    crawl.add_argument("--golden", help="directory of golden outputs to compare against")
+    crawl.add_argument("--update", action="store_true", help="write the golden outputs instead of comparing")
+    crawl.set_defaults(run=bench_crawl)
+
+    tracing = subparsers.add_parser("tracing", help="overhead of spans and counters")
+    tracing.add_argument("--iterations", type=int, default=200000)
+    tracing.set_defaults(run=bench_tracing)
+
+    args = parser.parse_args()
+    args.run(args)
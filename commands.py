@@ -0,0 +1,84 @@
+import re
+from collections import namedtuple
+
+# the actions a model answer can ask for; ids are the element ids of the crawl the model was shown
+Scroll = namedtuple("Scroll", ["direction"])
+Click = namedtuple("Click", ["id"])
+Type = namedtuple("Type", ["id", "text", "submit"])
+
+
+class CommandParseError(ValueError):
+    pass
+
+
+# The grammar, after whatever noise models like to put in front of a command (bullets, list numbers, quotes,
+# backticks, "Command:"):
+#
+#   command := SCROLL (UP | DOWN) | CLICK id | TYPE id text | TYPESUBMIT id text
+#   id      := digits, optionally written as id=7, #7 or [7]
+#   text    := the rest of the line, optionally quoted
+#
+# Keywords are case-insensitive and TYPESUBMIT may be spelled TYPE_SUBMIT or TYPE SUBMIT. Anything after a CLICK id
+# or a SCROLL direction is ignored, as the original prefix matching did.
+prefix_pattern = re.compile(r"(?:[\s>*`'\"\-•]+|\d+[.)]|(?:next\s+)?command\s*:)*", re.I)
+verb_pattern = re.compile(r"(TYPE[\s_-]*SUBMIT|TYPE|CLICK|SCROLL)\b\s*", re.I)
+direction_pattern = re.compile(r"(UP|DOWN)\b", re.I)
+id_pattern = re.compile(r"(?:id\s*[=:]?\s*|#|\[)?(\d+)\]?", re.I)
+opening_quotes = "\"'“‘"
+closing_quotes = "\"'”’"
+
+
+def parse_command(text):
+    # the first line of text as a Scroll, Click or Type; raises CommandParseError if it is not a command
+    line = text.strip().split("\n")[0].strip().rstrip("`")
+    line = line[prefix_pattern.match(line).end():]
+
+    verb = verb_pattern.match(line)
+    if verb is None:
+        raise CommandParseError(f"not a command: {line[:80]!r}")
+    keyword = re.sub(r"[\s_-]", "", verb.group(1)).upper()
+    rest = line[verb.end():]
+
+    if keyword == "SCROLL":
+        direction = direction_pattern.match(rest)
+        if direction is None:
+            raise CommandParseError(f"SCROLL needs UP or DOWN: {line[:80]!r}")
+        return Scroll(direction.group(1).lower())
+
+    target = id_pattern.match(rest)
+    if target is None:
+        raise CommandParseError(f"{keyword} needs an element id: {line[:80]!r}")
+    id = int(target.group(1))
+    if keyword == "CLICK":
+        return Click(id)
+
+    text = rest[target.end():].strip().lstrip(",:").strip()
+    if len(text) >= 2 and text[-1] == "." and text[-2] in closing_quotes:
+        text = text[:-1]
+    if text and text[0] in opening_quotes:
+        text = text[1:]
+    if text and text[-1] in closing_quotes:
+        text = text[:-1]
+    return Type(id, text, keyword == "TYPESUBMIT")
+
+
+def parse_commands(text, limit=None):
+    # the leading run of lines of text that are commands, at most `limit` of them
+    actions = []
+    for line in text.strip().split("\n"):
+        if limit is not None and len(actions) >= limit:
+            break
+        try:
+            actions.append(parse_command(line))
+        except CommandParseError:
+            break
+    return actions
+
+
+def format_command(action):
+    # the canonical spelling of action, which parse_command reads back unchanged
+    if isinstance(action, Scroll):
+        return f"SCROLL {action.direction.upper()}"
+    if isinstance(action, Click):
+        return f"CLICK {action.id}"
+    return f'{"TYPESUBMIT" if action.submit else "TYPE"} {action.id} "{action.text}"'
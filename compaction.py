@@ -0,0 +1,79 @@
+import re
+
+from tracing import tracer
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+if tiktoken is not None:
+    encoding = tiktoken.get_encoding("p50k_base")
+
+    def count_tokens(text):
+        return len(encoding.encode(text, disallowed_special=()))
+else:
+    # close enough to BPE counts for budgeting: one token per word or punctuation mark
+    token_pattern = re.compile(r"\w+|[^\w\s]")
+
+    def count_tokens(text):
+        return len(token_pattern.findall(text))
+
+element_pattern = re.compile(r"<(\w+) id=(\d+)")
+plain_text_pattern = re.compile(r"<text id=(\d+)>(.*)</text>", re.DOTALL)
+
+# lower ranks survive first
+element_ranks = {"input": 0, "button": 0, "link": 0, "img": 1, "text": 2}
+
+
+def merge_text(elements):
+    # folds runs of attribute-less <text> elements into the first one of the run, dropping repeated text
+    merged = []
+    seen_text = set()
+    run = None
+
+    for element in elements:
+        match = plain_text_pattern.fullmatch(element)
+        if match is None:
+            merged.append(element)
+            run = None
+            continue
+
+        text = match.group(2)
+        if text in seen_text:
+            continue
+        seen_text.add(text)
+
+        if run is None:
+            run = [match.group(1), text]
+            merged.append(run)
+        else:
+            run.append(text)
+
+    return [
+        element if isinstance(element, str) else "<text id={}>{}</text>".format(element[0], " ".join(element[1:]))
+        for element in merged
+    ]
+
+
+def compact(elements, budget=1200):
+    # Turns crawl output into prompt content of at most `budget` tokens: repeated text is dropped, adjacent text
+    # merged, and elements are admitted by rank (interactive first, then images, then text) in page order. The
+    # survivors keep their original order.
+    with tracer.span("compact", elements=len(elements)) as span:
+        elements = merge_text(elements)
+
+        def rank(position):
+            match = element_pattern.match(elements[position])
+            return element_ranks.get(match.group(1) if match else None, 2), position
+
+        kept = []
+        remaining = budget
+        for position in sorted(range(len(elements)), key=rank):
+            cost = count_tokens(elements[position]) + 1  # the newline joining it to the next element
+            if cost <= remaining:
+                kept.append(position)
+                remaining -= cost
+
+        span.set(kept=len(kept), tokens=budget - remaining)
+        return [elements[position] for position in sorted(kept)]
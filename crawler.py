@@ -1,382 +1,589 @@
+import asyncio
 import time
-from sys import platform
-
-from playwright.sync_api import sync_playwright
-
-black_listed_elements = {"html", "head", "title", "meta", "iframe", "body", "script", "style", "path", "svg", "br",
-                         "::marker"}
-
-
-def convert_name(node_name, has_click_handler):
-    if node_name == "a":
-        return "link"
-    if node_name == "input":
-        return "input"
-    if node_name == "img":
-        return "img"
-    if (
-            node_name == "button" or has_click_handler
-    ):  # found pages that needed this quirk
-        return "button"
-    else:
-        return "text"
-
-
-def find_attributes(attributes, keys, strings):
-    values = {}
-
-    for [key_index, value_index] in zip(*(iter(attributes),) * 2):
-        if value_index < 0:
-            continue
-        key = strings[key_index]
-        value = strings[value_index]
+from collections import namedtuple
+from functools import reduce
+
+from playwright.async_api import Error as AsyncError, TimeoutError as AsyncTimeoutError
+from playwright.sync_api import Error, TimeoutError, sync_playwright
+
+from extractor import extract_arguments, extract_js, focus_js, locate_js, render_extracted
+from resources import new_stats
+from snapshot import ColumnarSnapshot, render_snapshot, viewport_bounds
+from tracing import tracer
+
+# Everything crawl needs to know about the viewport, fetched in a single round-trip. The DOM fingerprint counts
+# mutations since the observers were installed, in the page and in every frame it can reach, plus input and change
+# events: typing, ticking a checkbox or picking an option changes what the snapshot shows without mutating the DOM.
+# Frames also add their scroll offsets, which move everything in them. A document's token changes whenever it is
+# replaced (navigation, reload), so the fingerprint stays equal while the snapshot is still right, except for form
+# state set by a script, which fires no event. Cross-origin frames cannot be observed; they mostly run out of process
+# and are not in the snapshot anyway, so they only count by their number.
+viewport_state_js = """
+() => {
+    const fingerprint = [];
+    (function observe(win) {
+        if (!win.__natbotDomState) {
+            const state = {token: Math.random().toString(36).slice(2), count: 0};
+            new win.MutationObserver(records => { state.count += records.length; }).observe(win.document, {
+                subtree: true, childList: true, attributes: true, characterData: true,
+            });
+            win.document.addEventListener("input", () => { state.count++; }, true);
+            win.document.addEventListener("change", () => { state.count++; }, true);
+            win.__natbotDomState = state;
+        }
+        fingerprint.push(win.__natbotDomState.token, win.__natbotDomState.count);
+        if (win !== window) {
+            fingerprint.push(win.scrollX, win.scrollY);
+        }
+        for (let i = 0; i < win.frames.length; i++) {
+            try {
+                observe(win.frames[i]);
+            } catch (e) {
+                fingerprint.push("cross-origin");
+            }
+        }
+    })(window);
+    return {
+        device_pixel_ratio: window.devicePixelRatio,
+        page_x_offset: window.pageXOffset,
+        page_y_offset: window.pageYOffset,
+        screen_width: window.screen.width,
+        screen_height: window.screen.height,
+        fingerprint: fingerprint,
+    };
+}
+"""
+
+scroll_js = {
+    "up": "(document.scrollingElement || document.body).scrollTop = (document.scrollingElement || document.body).scrollTop - window.innerHeight;",
+    "down": "(document.scrollingElement || document.body).scrollTop = (document.scrollingElement || document.body).scrollTop + window.innerHeight;",
+}
+
+# Installed once per page and run in every new document and frame: links open in the same tab, so the agent never
+# loses the page it is driving. Stripping target on the way down a click catches links added after load too.
+link_targets_js = """
+document.addEventListener("click", event => {
+    const link = event.target instanceof Element && event.target.closest("a[target]");
+    if (link) {
+        link.removeAttribute("target");
+    }
+}, true);
+"""
+
+# For clicks that cannot go through the node itself. Element coordinates are relative to the document. Scrolls the
+# window to scrollY if the point is outside of it and returns the scroll offsets to subtract from the point to get
+# window coordinates.
+reveal_js = """
+([x, y, scrollY]) => {
+    if (x < window.pageXOffset || x >= window.pageXOffset + window.innerWidth
+            || y < window.pageYOffset || y >= window.pageYOffset + window.innerHeight) {
+        window.scrollTo({left: Math.max(0, x - window.innerWidth / 2), top: scrollY, behavior: "instant"});
+    }
+    return [window.pageXOffset, window.pageYOffset];
+}
+"""
+
+# position tells the nodes that stay put on the screen while the page scrolls (see ColumnarSnapshot.fixed)
+capture_snapshot_params = {"computedStyles": ["position"], "includeDOMRects": True, "includePaintOrder": True}
+
+# Resolves with the elapsed milliseconds once the DOM has seen no mutation for quietMs, or after timeoutMs.
+dom_quiet_js = """
+([quietMs, timeoutMs]) => new Promise(resolve => {
+    const start = performance.now();
+    let quietTimer = null;
+    let capTimer = null;
+    const observer = new MutationObserver(() => {
+        clearTimeout(quietTimer);
+        quietTimer = setTimeout(done, quietMs);
+    });
+    function done() {
+        observer.disconnect();
+        clearTimeout(quietTimer);
+        clearTimeout(capTimer);
+        resolve(performance.now() - start);
+    }
+    observer.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    quietTimer = setTimeout(done, quietMs);
+    capTimer = setTimeout(done, timeoutMs);
+})
+"""
+
+# How long the DOM has to stay quiet after each kind of action, whether to wait for main-frame navigation requests
+# the action started to commit (or fail) first, and whether to also wait for the network to go idle when it
+# navigated. settle never waits longer than settle_timeout seconds in total.
+settle_policies = {
+    "scroll": {"dom_quiet_ms": 100, "navigation_requests": False, "network_idle": False},
+    "click": {"dom_quiet_ms": 300, "navigation_requests": True, "network_idle": True},
+    "type": {"dom_quiet_ms": 150, "navigation_requests": False, "network_idle": False},
+    "submit": {"dom_quiet_ms": 300, "navigation_requests": True, "network_idle": True},
+}
+# how often settle looks whether pending navigation requests are done, in milliseconds
+navigation_poll_ms = 50
+settle_timeout = 5
+
+
+def flatten(tree):
+    with tracer.span("crawl.flatten", documents=len(tree["documents"])) as span:
+        snapshot = ColumnarSnapshot(tree)
+        span.set(nodes=snapshot.node_count)
+    return snapshot
+
+
+def scroll_offsets(viewport_state):
+    return viewport_state["page_x_offset"], viewport_state["page_y_offset"]
+
+
+def quad_center(quads):
+    # the centre of the first quad with an area in a DOM.getContentQuads result, or None
+    for quad in quads:
+        xs = quad[0::2]
+        ys = quad[1::2]
+        if max(xs) > min(xs) and max(ys) > min(ys):
+            return sum(xs) / 4, sum(ys) / 4
+    return None
+
+
+# Crawler and AsyncCrawler share their logic as generators (the *_steps methods of CrawlerBase) that yield what they
+# need done and get the result sent back, or the playwright error thrown in. run carries them out with the sync API,
+# run_async with the async one. A Call names a method by its path from the crawler, e.g. "page.mouse.click"; a Gather
+# runs several generators, concurrently with the async API, and sends back the list of their results.
+Call = namedtuple("Call", ["path", "args", "kwargs"])
+Gather = namedtuple("Gather", ["steps"])
+
+# what the generators catch, whichever API raised it
+page_errors = (Error, AsyncError)
+timeout_errors = (TimeoutError, AsyncTimeoutError)
+
+
+def call(path, *args, **kwargs):
+    return Call(path, args, kwargs)
+
+
+def single(operation):
+    # a generator of one operation, for Gather
+    return (yield operation)
+
+
+def resolve(crawler, path):
+    return reduce(getattr, path.split("."), crawler)
+
+
+def run(crawler, steps):
+    value = error = None
+    while True:
+        try:
+            operation = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        value = error = None
+        try:
+            if isinstance(operation, Gather):
+                value = [run(crawler, gathered) for gathered in operation.steps]
+            else:
+                value = resolve(crawler, operation.path)(*operation.args, **operation.kwargs)
+        except Error as e:
+            error = e
+
+
+async def run_async(crawler, steps):
+    value = error = None
+    while True:
+        try:
+            operation = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        value = error = None
+        try:
+            if isinstance(operation, Gather):
+                value = list(await asyncio.gather(*(run_async(crawler, gathered) for gathered in operation.steps)))
+            else:
+                value = await resolve(crawler, operation.path)(*operation.args, **operation.kwargs)
+        except AsyncError as e:
+            error = e
+
+
+class CrawlerBase:
+    # With full_page, crawl lists every element of the document rather than just those in the window; click scrolls
+    # to off-screen elements by itself. extractor picks how crawl reads the page: "snapshot" transfers a
+    # DOMSnapshot and filters it here, "js" runs the same filtering in the page (see extractor.py) and only transfers
+    # the elements, which pays off on large documents. With a resources.ResourcePolicy, requests are filtered (and
+    # maybe served from an asset cache) before they reach the network; resource_stats counts them for the current page.
+    # whether the subclass drives the generators with the async API
+    asynchronous = False
+
+    def __init__(self, page, full_page=False, extractor="snapshot", resources=None):
+        self.page = page
+        self.full_page = full_page
+        self.extractor = extractor
+        self.resources = resources
+        self.resource_stats = new_stats()
+        # the DevTools session blocking is installed on, when it does not need a route (see install_steps)
+        self.resource_session = None
+        # optionally something like replay.Recorder, which is handed every snapshot and crawl
+        self.recorder = None
+        self.timings = {}
+        self.last_settle = {}
+        self.navigations = 0
+        self.settled_navigations = 0
+        # main-frame navigation requests that have neither committed nor failed yet
+        self.pending_navigations = set()
+        self.page_element_buffer = {}
+        self.snapshot = None
+        self.snapshot_fingerprint = None
+        self.snapshot_scroll = None
+        # the fingerprint prefetch saw last, see AsyncCrawler.prefetch
+        self.prefetch_fingerprint = None
+        self.installed = False
+        self.page.on("framenavigated", self.on_navigated)
+        self.page.on("request", self.on_request)
+        # a navigation that does not commit (a download, a 204) still finishes or fails
+        self.page.on("requestfinished", self.pending_navigations.discard)
+        self.page.on("requestfailed", self.pending_navigations.discard)
+
+    def on_navigated(self, frame):
+        if frame == self.page.main_frame:
+            self.navigations += 1
+            self.pending_navigations.clear()
+            # in place, the route handler holds on to this dict
+            self.resource_stats.update(new_stats())
+
+    def on_request(self, request):
+        self.resource_stats["requests"] += 1
+        if request.is_navigation_request() and request.frame == self.page.main_frame:
+            self.pending_navigations.add(request)
+
+    def install_steps(self):
+        # What the page needs before it loads anything: link_targets_js and the resource policy. Crawler installs
+        # them right away, AsyncCrawler (which cannot wait in its constructor) before its first go_to_page.
+        if self.installed:
+            return
+        self.installed = True
+        yield call("page.add_init_script", link_targets_js)
+        if self.resources is None:
+            return
+        if self.resources.cache is None:
+            # blocking alone does not need a route, which would turn the browser's HTTP cache off
+            self.resource_session = yield call("page.context.new_cdp_session", self.page)
+            intercept = "resources.intercept_async" if self.asynchronous else "resources.intercept"
+            yield call(intercept, self.resource_session, self.resource_stats)
+        else:
+            route = "resources.route_async" if self.asynchronous else "resources.route"
+            yield call(route, self.page, self.resource_stats)
 
-        if key in keys:
-            values[key] = value
-            keys.remove(key)
+    def go_to_page_steps(self, url):
+        yield from self.install_steps()
+        yield call("page.goto", url=url if "://" in url else "http://" + url)
+        self.client = yield call("page.context.new_cdp_session", self.page)
+        self.page_element_buffer = {}
+        self.snapshot = None
+        self.snapshot_fingerprint = None
+        self.settled_navigations = self.navigations
+        self.pending_navigations.clear()
+
+    def scroll_steps(self, direction):
+        if direction in scroll_js:
+            yield call("page.evaluate", scroll_js[direction])
+
+    def locate_steps(self, element):
+        # Scrolls the node the crawl saw into view and returns the middle of where it is now, so a reflow since the
+        # crawl does not matter; None if the node is gone or has no box. Both commands go out at once with the async
+        # API and are answered in order, so that is one round-trip.
+        try:
+            if element.backend_node_id is None:
+                return (yield call("page.evaluate", locate_js, element.node_key))
+            node = {"backendNodeId": element.backend_node_id}
+            _, quads = yield Gather([
+                single(call("client.send", "DOM.scrollIntoViewIfNeeded", node)),
+                single(call("client.send", "DOM.getContentQuads", node)),
+            ])
+            return quad_center(quads["quads"])
+        except page_errors:
+            return None
+
+    def click_steps(self, id):
+        element = self.page_element_buffer.get(int(id))
+        if element:
+            # only if the node cannot be located any more, fall back to the crawled position
+            center = yield from self.locate_steps(element)
+            if center is None:
+                x = element.center_x
+                y = element.center_y
+                offset_x, offset_y = yield call("page.evaluate", reveal_js, [x, y, element.scroll_y])
+                center = x - offset_x, y - offset_y
+
+            yield call("page.mouse.click", *center)
+        else:
+            print("Could not find element")
 
-            if not keys:
-                return values
+    def focus_steps(self, element):
+        try:
+            if element.backend_node_id is None:
+                return (yield call("page.evaluate", focus_js, element.node_key))
+            yield call("client.send", "DOM.focus", {"backendNodeId": element.backend_node_id})
+            return True
+        except page_errors:
+            return False
+
+    def type_steps(self, id, text):
+        # focusing the node is enough for typing; elements that cannot take focus get clicked instead
+        element = self.page_element_buffer.get(int(id))
+        if not element or not (yield from self.focus_steps(element)):
+            yield from self.click_steps(id)
+        yield call("page.keyboard.type", text)
+
+    def settle_steps(self, action):
+        # Wait for the page to react to `action`: for a navigation, the new document's DOMContentLoaded (and network
+        # idle if the policy asks for it); then a quiet window without DOM mutations. Returns the seconds waited.
+        #
+        # A slow server can keep a navigation from committing for longer than the quiet window, which would then pass
+        # on the old document and leave the next crawl to run into the replaced one. So for actions that navigate,
+        # pending main-frame navigation requests are waited out before the window starts and looked for again after.
+        with tracer.span("settle", action=action) as span:
+            policy = settle_policies[action]
+            start = time.time()
+            deadline = start + settle_timeout
+            signals = []
+
+            while time.time() < deadline:
+                if policy["navigation_requests"] and self.pending_navigations:
+                    while self.pending_navigations and time.time() < deadline:
+                        yield call("page.wait_for_timeout", navigation_poll_ms)
+                    if self.pending_navigations:
+                        signals.append("timeout")
+                        break
+                    signals.append("request")
+
+                if self.navigations != self.settled_navigations:
+                    self.settled_navigations = self.navigations
+                    try:
+                        yield call(
+                            "page.wait_for_load_state", "domcontentloaded",
+                            timeout=max(1, (deadline - time.time()) * 1000),
+                        )
+                        signals.append("navigation")
+                        if policy["network_idle"]:
+                            yield call(
+                                "page.wait_for_load_state", "networkidle",
+                                timeout=max(1, (deadline - time.time()) * 1000),
+                            )
+                            signals.append("network")
+                    except timeout_errors:
+                        signals.append("timeout")
+                        break
+
+                try:
+                    yield call("page.evaluate", dom_quiet_js, [policy["dom_quiet_ms"], (deadline - time.time()) * 1000])
+                    signals.append("dom")
+                except page_errors:
+                    # the document was replaced while we were watching it
+                    continue
 
-    return values
+                if self.navigations == self.settled_navigations and not (
+                    policy["navigation_requests"] and self.pending_navigations
+                ):
+                    break
+
+            self.last_settle = {"action": action, "seconds": time.time() - start, "signals": signals}
+            span.set(signals=signals)
+            return self.last_settle["seconds"]
+
+    def viewport_state_steps(self):
+        with tracer.span("crawl.viewport"):
+            return (yield call("page.evaluate", viewport_state_js))
+
+    def capture_steps(self):
+        with tracer.span("crawl.capture"):
+            tree = yield call("client.send", "DOMSnapshot.captureSnapshot", capture_snapshot_params)
+        if self.recorder is not None:
+            self.recorder.snapshot(tree)
+        return tree
+
+    def snapshot_is_current(self, viewport_state):
+        # scrolling does not touch the DOM, so an unchanged fingerprint means the cached snapshot only has to be
+        # culled against the new viewport (fixed nodes moved along, see scroll_delta); unless it has sticky nodes
+        if self.snapshot is None or viewport_state["fingerprint"] != self.snapshot_fingerprint:
+            return False
+        return not self.snapshot.scroll_dependent or scroll_offsets(viewport_state) == self.snapshot_scroll
+
+    def scroll_delta(self, viewport_state):
+        # how far the window scrolled since the cached snapshot was captured
+        x, y = scroll_offsets(viewport_state)
+        snapshot_x, snapshot_y = self.snapshot_scroll
+        return x - snapshot_x, y - snapshot_y
+
+    def flatten(self, tree):
+        return flatten(tree)
+
+    def keep_snapshot_steps(self, tree, viewport_state):
+        self.snapshot = yield call("flatten", tree)
+        self.snapshot_fingerprint = viewport_state["fingerprint"]
+        self.snapshot_scroll = scroll_offsets(viewport_state)
+
+    def extract_steps(self):
+        # crawl with the in-page extractor; there is no snapshot to cache or record
+        with tracer.span("crawl", full_page=self.full_page, extractor="js") as span:
+            self.page_element_buffer.clear()
+            start = time.time()
+            with tracer.span("crawl.extract"):
+                result = yield call("page.evaluate", extract_js, extract_arguments(self.full_page))
+            extract_done = time.time()
+            elements_of_interest = render_extracted(result, self.page_element_buffer)
+            span.set(nodes=result["nodes"], elements=len(elements_of_interest))
+
+            self.timings = {"extract": extract_done - start, "parse": time.time() - extract_done}
+            return elements_of_interest
+
+    def crawl_steps(self, extractor=None):
+        # extractor overrides self.extractor for this crawl
+        if (extractor or self.extractor) == "js":
+            return (yield from self.extract_steps())
+
+        with tracer.span("crawl", full_page=self.full_page) as span:
+            # ids are handed out afresh on every crawl, anything left over from the previous one would be stale
+            self.page_element_buffer.clear()
+            start = time.time()
+
+            if self.snapshot is None:
+                # nothing is cached, so the capture does not depend on the fingerprint and (with the async API) both
+                # round-trips can be in flight at once. The evaluation is sent first, so a mutation in between only
+                # makes the stored fingerprint stale, which forces a fresh capture next time.
+                viewport_state, tree = yield Gather([self.viewport_state_steps(), self.capture_steps()])
+                viewport_done = time.time()
+                captured = True
+            else:
+                viewport_state = yield from self.viewport_state_steps()
+                viewport_done = time.time()
+                captured = not self.snapshot_is_current(viewport_state)
+                if captured:
+                    tree = yield from self.capture_steps()
+            if captured:
+                yield from self.keep_snapshot_steps(tree, viewport_state)
+            snapshot_done = time.time()
+
+            scroll_delta = self.scroll_delta(viewport_state)
+            elements_of_interest = render_snapshot(
+                self.snapshot, *viewport_bounds(viewport_state), self.page_element_buffer, self.full_page, scroll_delta
+            )
+            parse_done = time.time()
+            span.set(captured=captured, elements=len(elements_of_interest))
+            if self.recorder is not None:
+                self.recorder.crawl(self.page.url, viewport_state, self.full_page, scroll_delta)
+
+            # when nothing was cached, "viewport" includes the capture, the two overlap
+            self.timings = {
+                "viewport": viewport_done - start,
+                "snapshot": snapshot_done - viewport_done,
+                "parse": parse_done - snapshot_done,
+            }
+            return elements_of_interest
 
 
-def add_to_hash_tree(hash_tree, tag, node_id, node_name, parent_id, strings, parent, node_names):
-    parent_id_str = str(parent_id)
-    if not parent_id_str in hash_tree:
-        parent_name = strings[node_names[parent_id]].lower()
-        grand_parent_id = parent[parent_id]
+class Crawler(CrawlerBase):
+    def __init__(self, page=None, headless=False, full_page=False, extractor="snapshot", resources=None):
+        if page is None:
+            self.browser = (
+                sync_playwright()
+                .start()
+                .chromium.launch(
+                    headless=headless,
+                )
+            )
 
-        add_to_hash_tree(
-            hash_tree, tag, parent_id, parent_name, grand_parent_id
-        )
+            page = self.browser.new_page()
+            page.set_viewport_size({"width": 1280, "height": 1080})
+        else:
+            self.browser = page.context.browser
 
-    is_parent_desc_anchor, anchor_id = hash_tree[parent_id_str]
+        super().__init__(page, full_page, extractor, resources)
+        run(self, self.install_steps())
 
-    # even if the anchor is nested in another anchor, we set the "root" for all descendants to be ::Self
-    if node_name == tag:
-        value = (True, node_id)
-    elif (
-            is_parent_desc_anchor
-    ):  # reuse the parent's anchor_id (which could be much higher in the tree)
-        value = (True, anchor_id)
-    else:
-        value = (
-            False,
-            None,
-        )  # not a descendant of an anchor, most likely it will become text, an interactive element or discarded
+    def go_to_page(self, url):
+        run(self, self.go_to_page_steps(url))
 
-    hash_tree[str(node_id)] = value
+    def scroll(self, direction):
+        run(self, self.scroll_steps(direction))
 
-    return value
+    def click(self, id):
+        run(self, self.click_steps(id))
 
+    def type(self, id, text):
+        run(self, self.type_steps(id, text))
 
-class Crawler:
-    def __init__(self):
-        self.browser = (
-            sync_playwright()
-            .start()
-            .chromium.launch(
-                headless=False,
-            )
-        )
+    def enter(self):
+        self.page.keyboard.press("Enter")
 
-        self.page = self.browser.new_page()
-        self.page.set_viewport_size({"width": 1280, "height": 1080})
+    def settle(self, action):
+        return run(self, self.settle_steps(action))
 
-    def go_to_page(self, url):
-        self.page.goto(url=url if "://" in url else "http://" + url)
-        self.client = self.page.context.new_cdp_session(self.page)
-        self.page_element_buffer = {}
+    def crawl(self, extractor=None):
+        return run(self, self.crawl_steps(extractor))
 
-    def scroll(self, direction):
-        if direction == "up":
-            self.page.evaluate(
-                "(document.scrollingElement || document.body).scrollTop = (document.scrollingElement || document.body).scrollTop - window.innerHeight;"
-            )
-        elif direction == "down":
-            self.page.evaluate(
-                "(document.scrollingElement || document.body).scrollTop = (document.scrollingElement || document.body).scrollTop + window.innerHeight;"
-            )
 
-    def click(self, id):
-        # Inject javascript into the page which removes the target= attribute from all links
-        js = """
-		links = document.getElementsByTagName("a");
-		for (var i = 0; i < links.length; i++) {
-			links[i].removeAttribute("target");
-		}
-		"""
-        self.page.evaluate(js)
+class AsyncCrawler(CrawlerBase):
+    # Same surface as Crawler, on top of playwright.async_api. Sessions are created from a shared browser, each in
+    # its own context, so one event loop and one browser process can drive many agents.
+    asynchronous = True
 
-        element = self.page_element_buffer.get(int(id))
-        if element:
-            x = element.get("center_x")
-            y = element.get("center_y")
+    def __init__(self, page, full_page=False, extractor="snapshot", resources=None):
+        super().__init__(page, full_page, extractor, resources)
+        self.browser = page.context.browser
 
-            self.page.mouse.click(x, y)
-        else:
-            print("Could not find element")
+    @classmethod
+    async def create(cls, browser, resources=None):
+        context = await browser.new_context(viewport={"width": 1280, "height": 1080})
+        return cls(await context.new_page(), resources=resources)
 
-    def type(self, id, text):
-        self.click(id)
-        self.page.keyboard.type(text)
+    async def close(self):
+        await self.page.context.close()
 
-    def enter(self):
-        self.page.keyboard.press("Enter")
+    async def flatten(self, tree):
+        # the other sessions on the event loop keep going while a large snapshot is being flattened
+        return await asyncio.to_thread(flatten, tree)
 
-    def crawl(self):
-        page = self.page
-        page_element_buffer = self.page_element_buffer
-        start = time.time()
-
-        page_state_as_text = []
-
-        device_pixel_ratio = page.evaluate("window.devicePixelRatio")
-        if platform == "darwin" and device_pixel_ratio == 1:  # lies
-            device_pixel_ratio = 2
-
-        win_upper_bound = page.evaluate("window.pageYOffset")
-        win_left_bound = page.evaluate("window.pageXOffset")
-        win_width = page.evaluate("window.screen.width")
-        win_height = page.evaluate("window.screen.height")
-        win_right_bound = win_left_bound + win_width
-        win_lower_bound = win_upper_bound + win_height
-
-        percentage_progress_start = 1
-        percentage_progress_end = 2
-
-        page_state_as_text.append(
-            {
-                "x": 0,
-                "y": 0,
-                "text": "[scrollbar {:0.2f}-{:0.2f}%]".format(
-                    round(percentage_progress_start, 2), round(percentage_progress_end)
-                ),
-            }
-        )
-
-        tree = self.client.send(
-            "DOMSnapshot.captureSnapshot",
-            {"computedStyles": [], "includeDOMRects": True, "includePaintOrder": True},
-        )
-        strings = tree["strings"]
-        document = tree["documents"][0]
-        nodes = document["nodes"]
-        backend_node_id = nodes["backendNodeId"]
-        attributes = nodes["attributes"]
-        node_value = nodes["nodeValue"]
-        parent = nodes["parentIndex"]
-        node_types = nodes["nodeType"]
-        node_names = nodes["nodeName"]
-        is_clickable = set(nodes["isClickable"]["index"])
-
-        text_value = nodes["textValue"]
-        text_value_index = text_value["index"]
-        text_value_values = text_value["value"]
-
-        input_value = nodes["inputValue"]
-        input_value_index = input_value["index"]
-        input_value_values = input_value["value"]
-
-        input_checked = nodes["inputChecked"]
-        layout = document["layout"]
-        layout_node_index = layout["nodeIndex"]
-        bounds = layout["bounds"]
-
-        cursor = 0
-        html_elements_text = []
-
-        child_nodes = {}
-        elements_in_view_port = []
-
-        anchor_ancestry = {"-1": (False, None)}
-        button_ancestry = {"-1": (False, None)}
-
-        for index, node_name_index in enumerate(node_names):
-            node_parent = parent[index]
-            node_name = strings[node_name_index].lower()
-
-            is_ancestor_of_anchor, anchor_id = add_to_hash_tree(
-                anchor_ancestry, "a", index, node_name, node_parent, strings, parent, node_names
-            )
+    async def go_to_page(self, url):
+        await run_async(self, self.go_to_page_steps(url))
 
-            is_ancestor_of_button, button_id = add_to_hash_tree(
-                button_ancestry, "button", index, node_name, node_parent, strings, parent, node_names
-            )
+    async def scroll(self, direction):
+        await run_async(self, self.scroll_steps(direction))
 
-            try:
-                cursor = layout_node_index.index(
-                    index
-                )  # todo replace this with proper cursoring, ignoring the fact this is O(n^2) for the moment
-            except:
-                continue
-
-            if node_name in black_listed_elements:
-                continue
-
-            [x, y, width, height] = bounds[cursor]
-            x /= device_pixel_ratio
-            y /= device_pixel_ratio
-            width /= device_pixel_ratio
-            height /= device_pixel_ratio
-
-            elem_left_bound = x
-            elem_top_bound = y
-            elem_right_bound = x + width
-            elem_lower_bound = y + height
-
-            partially_is_in_viewport = (
-                    elem_left_bound < win_right_bound
-                    and elem_right_bound >= win_left_bound
-                    and elem_top_bound < win_lower_bound
-                    and elem_lower_bound >= win_upper_bound
-            )
+    async def click(self, id):
+        await run_async(self, self.click_steps(id))
 
-            if not partially_is_in_viewport:
-                continue
+    async def type(self, id, text):
+        await run_async(self, self.type_steps(id, text))
 
-            meta_data = []
+    async def enter(self):
+        await self.page.keyboard.press("Enter")
 
-            # inefficient to grab the same set of keys for kinds of objects, but it's fine for now
-            element_attributes = find_attributes(
-                attributes[index], ["type", "placeholder", "aria-label", "title", "alt"], strings
-            )
+    async def settle(self, action):
+        return await run_async(self, self.settle_steps(action))
 
-            ancestor_exception = is_ancestor_of_anchor or is_ancestor_of_button
-            ancestor_node_key = (
-                None
-                if not ancestor_exception
-                else str(anchor_id)
-                if is_ancestor_of_anchor
-                else str(button_id)
-            )
-            ancestor_node = (
-                None
-                if not ancestor_exception
-                else child_nodes.setdefault(str(ancestor_node_key), [])
-            )
+    async def crawl(self, extractor=None):
+        return await run_async(self, self.crawl_steps(extractor))
 
-            if node_name == "#text" and ancestor_exception:
-                text = strings[node_value[index]]
-                if text == "|" or text == "•":
-                    continue
-                ancestor_node.append({
-                    "type": "type", "value": text
-                })
-            else:
-                if (
-                        node_name == "input" and element_attributes.get("type") == "submit"
-                ) or node_name == "button":
-                    node_name = "button"
-                    element_attributes.pop(
-                        "type", None
-                    )  # prevent [button ... (button)..]
-
-                for key in element_attributes:
-                    if ancestor_exception:
-                        ancestor_node.append({
-                            "type": "attribute",
-                            "key": key,
-                            "value": element_attributes[key]
-                        })
-                    else:
-                        meta_data.append(element_attributes[key])
-
-            element_node_value = None
-
-            if node_value[index] >= 0:
-                element_node_value = strings[node_value[index]]
-                if element_node_value == "|":  # commonly used as a seperator, does not add much context - lets save ourselves some token space
-                    continue
-            elif (
-                    node_name == "input"
-                    and index in input_value_index
-                    and element_node_value is None
-            ):
-                node_input_text_index = input_value_index.index(index)
-                text_index = input_value_values[node_input_text_index]
-                if node_input_text_index >= 0 and text_index >= 0:
-                    element_node_value = strings[text_index]
-
-            # remove redudant elements
-            if ancestor_exception and (node_name != "a" and node_name != "button"):
-                continue
-
-            elements_in_view_port.append(
-                {
-                    "node_index": str(index),
-                    "backend_node_id": backend_node_id[index],
-                    "node_name": node_name,
-                    "node_value": element_node_value,
-                    "node_meta": meta_data,
-                    "is_clickable": index in is_clickable,
-                    "origin_x": int(x),
-                    "origin_y": int(y),
-                    "center_x": int(x + (width / 2)),
-                    "center_y": int(y + (height / 2)),
-                }
-            )
+    def prefetch_steps(self):
+        if self.extractor == "js":
+            return False
+        try:
+            viewport_state = yield from self.viewport_state_steps()
+            fingerprint = viewport_state["fingerprint"]
+            if self.snapshot_is_current(viewport_state) or fingerprint != self.prefetch_fingerprint:
+                self.prefetch_fingerprint = fingerprint
+                return False
+            tree = yield from self.capture_steps()
+        except page_errors:
+            # navigating; whatever we would capture now is about to be replaced
+            return False
 
-        # lets filter further to remove anything that does not hold any text nor has click handlers + merge text from leaf#text nodes with the parent
-        elements_of_interest = []
-        id_counter = 0
-
-        for element in elements_in_view_port:
-            node_index = element.get("node_index")
-            node_name = element.get("node_name")
-            node_value = element.get("node_value")
-            is_clickable = element.get("is_clickable")
-            origin_x = element.get("origin_x")
-            origin_y = element.get("origin_y")
-            center_x = element.get("center_x")
-            center_y = element.get("center_y")
-            meta_data = element.get("node_meta")
-
-            inner_text = f"{node_value} " if node_value else ""
-            meta = ""
-
-            if node_index in child_nodes:
-                for child in child_nodes.get(node_index):
-                    entry_type = child.get('type')
-                    entry_value = child.get('value')
-
-                    if entry_type == "attribute":
-                        entry_key = child.get('key')
-                        meta_data.append(f'{entry_key}="{entry_value}"')
-                    else:
-                        inner_text += f"{entry_value} "
-
-            if meta_data:
-                meta_string = " ".join(meta_data)
-                meta = f" {meta_string}"
-
-            if inner_text != "":
-                inner_text = f"{inner_text.strip()}"
-
-            converted_node_name = convert_name(node_name, is_clickable)
-
-            # not very elegant, more like a placeholder
-            if (
-                    (converted_node_name != "button" or meta == "")
-                    and converted_node_name != "link"
-                    and converted_node_name != "input"
-                    and converted_node_name != "img"
-                    and converted_node_name != "textarea"
-            ) and inner_text.strip() == "":
-                continue
-
-            page_element_buffer[id_counter] = element
-
-            if inner_text != "":
-                elements_of_interest.append(
-                    f"""<{converted_node_name} id={id_counter}{meta}>{inner_text}</{converted_node_name}>"""
-                )
-            else:
-                elements_of_interest.append(
-                    f"""<{converted_node_name} id={id_counter}{meta}/>"""
-                )
-            id_counter += 1
+        yield from self.keep_snapshot_steps(tree, viewport_state)
+        return True
 
-        print("Parsing time: {:0.2f} seconds".format(time.time() - start))
-        return elements_of_interest
+    async def prefetch(self):
+        # Brings the cached snapshot up to date without rendering or renumbering anything, so it can run while the
+        # model is still choosing among the ids of the last crawl. The next crawl then only has to cull, unless the
+        # DOM changes again in between. Only captures once the fingerprint is the same as on the previous call, so
+        # calling it every so often captures after the DOM has been quiet for that long rather than on every
+        # mutation. Returns whether a new snapshot was captured.
+        return await run_async(self, self.prefetch_steps())
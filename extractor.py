@@ -0,0 +1,237 @@
+from snapshot import Element, attribute_keys, black_listed_elements, render_elements
+
+# The in-page counterpart of ColumnarSnapshot + render_survivors: walks the page and its same-origin frames in
+# document order (open shadow roots included), culls against the window, drops black-listed elements and folds the
+# text and attributes of anchor/button descendants into their anchor/button. Only the resulting element records
+# travel back, ready for render_elements.
+#
+# Differences from a DOMSnapshot crawl: there are no backend node ids (nodes are keyed in a WeakMap instead, stable
+# for as long as the document lives), closed shadow roots and user-agent shadow trees are out of reach, and
+# is_clickable can only see natively clickable elements, onclick handlers and role=button, not listeners added with
+# addEventListener.
+extract_js = """
+([fullPage, blackListed, attributeKeys]) => {
+    blackListed = new Set(blackListed);
+    const nativelyClickable = new Set(["a", "button", "input", "select", "textarea", "summary", "option"]);
+    if (!window.__natbotNodeKeys) {
+        window.__natbotNodeKeys = new WeakMap();
+        window.__natbotNextNodeKey = 0;
+    }
+    const nodeKeys = window.__natbotNodeKeys;
+    const extracted = window.__natbotExtracted = new Map();
+
+    const left = window.pageXOffset;
+    const upper = window.pageYOffset;
+    const right = left + window.screen.width;
+    const lower = upper + window.screen.height;
+    const halfHeight = Math.floor(window.screen.height / 2);
+
+    const elements = [];
+    const childNodes = {};
+    let nodeIndex = 0;
+
+    // [document, x and y to add to its client rects, clip in top document coordinates]
+    const documents = [[document, window.pageXOffset, window.pageYOffset, [-Infinity, -Infinity, Infinity, Infinity]]];
+    for (let d = 0; d < documents.length; d++) {
+        const [doc, baseX, baseY, clip] = documents[d];
+        const range = doc.createRange();
+        const stack = [[doc, -1, -1]];
+
+        while (stack.length) {
+            const [node, parentAnchor, parentButton] = stack.pop();
+            const index = nodeIndex++;
+            const isElement = node.nodeType === 1;
+            const isText = node.nodeType === 3;
+            let nodeName = node.nodeName.toLowerCase();
+            let anchor = parentAnchor;
+            let button = parentButton;
+            if (nodeName === "a") {
+                anchor = index;
+            } else if (nodeName === "button") {
+                button = index;
+            }
+
+            const children = [];
+            if (isElement && node.shadowRoot) {
+                children.push(...node.shadowRoot.childNodes);
+            }
+            children.push(...node.childNodes);
+            for (let i = children.length - 1; i >= 0; i--) {
+                stack.push([children[i], anchor, button]);
+            }
+
+            let rects = null;
+            if (isElement) {
+                rects = node.getClientRects();
+            } else if (isText) {
+                range.selectNodeContents(node);
+                rects = range.getClientRects();
+            }
+            if (!rects || !rects.length) {
+                continue;
+            }
+            const rect = isElement ? node.getBoundingClientRect() : range.getBoundingClientRect();
+            const x = rect.left + baseX;
+            const y = rect.top + baseY;
+            const width = rect.width;
+            const height = rect.height;
+
+            if (isElement && (nodeName === "iframe" || nodeName === "frame")) {
+                let contentDocument = null;
+                try {
+                    contentDocument = node.contentDocument;
+                } catch (e) {
+                }
+                if (contentDocument && contentDocument.documentElement) {
+                    documents.push([contentDocument, x, y, [
+                        Math.max(x, clip[0]), Math.max(y, clip[1]),
+                        Math.min(x + width, clip[2]), Math.min(y + height, clip[3]),
+                    ]]);
+                }
+            }
+
+            if (blackListed.has(nodeName)) {
+                continue;
+            }
+            if (!(x < clip[2] && x + width >= clip[0] && y < clip[3] && y + height >= clip[1])) {
+                continue;
+            }
+            if (!fullPage && !(x < right && x + width >= left && y < lower && y + height >= upper)) {
+                continue;
+            }
+
+            const ancestorException = anchor >= 0 || button >= 0;
+            const ancestorNode = ancestorException
+                ? (childNodes[anchor >= 0 ? anchor : button] = childNodes[anchor >= 0 ? anchor : button] || [])
+                : null;
+            const meta = [];
+
+            const attributes = [];
+            if (isElement) {
+                for (const attribute of node.attributes) {
+                    if (attributeKeys.includes(attribute.name) && !attributes.some(([key]) => key === attribute.name)) {
+                        attributes.push([attribute.name, attribute.value]);
+                    }
+                }
+            }
+
+            if (isText && ancestorException) {
+                const text = node.nodeValue;
+                if (text === "|" || text === "•") {
+                    continue;
+                }
+                ancestorNode.push([null, text]);
+            } else {
+                const type = attributes.find(([key]) => key === "type");
+                if ((nodeName === "input" && type && type[1] === "submit") || nodeName === "button") {
+                    nodeName = "button";
+                    if (type) {
+                        attributes.splice(attributes.indexOf(type), 1);
+                    }
+                }
+                for (const [key, value] of attributes) {
+                    if (ancestorException) {
+                        ancestorNode.push([key, value]);
+                    } else {
+                        meta.push(value);
+                    }
+                }
+            }
+
+            let nodeValue = null;
+            if (isText) {
+                nodeValue = node.nodeValue;
+                if (nodeValue === "|") {
+                    continue;
+                }
+            } else if (nodeName === "input") {
+                nodeValue = node.value;
+            }
+
+            if (ancestorException && nodeName !== "a" && nodeName !== "button") {
+                continue;
+            }
+
+            let key = nodeKeys.get(node);
+            if (key === undefined) {
+                key = ++window.__natbotNextNodeKey;
+                nodeKeys.set(node, key);
+            }
+            extracted.set(key, node);
+
+            const centerY = Math.trunc(y + height / 2);
+            elements.push({
+                node_index: index,
+                backend_node_id: null,
+                node_key: key,
+                node_name: nodeName,
+                node_value: nodeValue,
+                node_meta: meta,
+                is_clickable: isElement && (
+                    nativelyClickable.has(node.nodeName.toLowerCase()) || node.onclick !== null
+                    || node.getAttribute("role") === "button"
+                ),
+                origin_x: Math.trunc(x),
+                origin_y: Math.trunc(y),
+                center_x: Math.trunc(x + width / 2),
+                center_y: centerY,
+                scroll_y: Math.max(0, centerY - halfHeight),
+            });
+        }
+    }
+
+    return {elements: elements, child_nodes: childNodes, nodes: nodeIndex};
+}
+"""
+
+# Scrolls the node an extracted element came from into view and returns its centre in window coordinates, or null
+# if the node is gone.
+locate_js = """
+key => {
+    const node = window.__natbotExtracted && window.__natbotExtracted.get(key);
+    if (!node || !node.isConnected) {
+        return null;
+    }
+    const element = node.nodeType === 1 ? node : node.parentElement;
+    element.scrollIntoViewIfNeeded(true);
+
+    let rect;
+    if (node.nodeType === 1) {
+        rect = node.getBoundingClientRect();
+    } else {
+        const range = node.ownerDocument.createRange();
+        range.selectNodeContents(node);
+        rect = range.getBoundingClientRect();
+    }
+    let x = rect.left + rect.width / 2;
+    let y = rect.top + rect.height / 2;
+    for (let win = node.ownerDocument.defaultView; win !== window && win.frameElement; win = win.parent) {
+        const frameRect = win.frameElement.getBoundingClientRect();
+        x += frameRect.left;
+        y += frameRect.top;
+    }
+    return [x, y];
+}
+"""
+
+focus_js = """
+key => {
+    const node = window.__natbotExtracted && window.__natbotExtracted.get(key);
+    if (!node || !node.isConnected || node.nodeType !== 1) {
+        return false;
+    }
+    node.focus();
+    return node.ownerDocument.activeElement === node;
+}
+"""
+
+
+def extract_arguments(full_page):
+    return [full_page, sorted(black_listed_elements), attribute_keys]
+
+
+def render_extracted(result, page_element_buffer):
+    # JSON object keys are strings, the node indexes they stand for are not
+    elements = [Element(**element) for element in result["elements"]]
+    child_nodes = {int(node_index): entries for node_index, entries in result["child_nodes"].items()}
+    return render_elements(elements, child_nodes, page_element_buffer)
@@ -0,0 +1,200 @@
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from compaction import count_tokens
+
+retryable_statuses = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CompletionError(Exception):
+    pass
+
+
+def cached_tokens(usage):
+    # prompt tokens the server served from its prefix cache, None if it does not say (the legacy completions endpoint
+    # never does), so that not knowing does not read as a cache miss
+    return (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+
+
+class HTTPCompletionBackend:
+    # An OpenAI-compatible /completions client. Every thread keeps one connection alive across requests, failed
+    # requests are retried with jittered exponential backoff, and n/best_of are only sent when asked for.
+    #
+    # What natbot.py relies on, and another backend would have to provide: complete(prompt, max_tokens, done) returns
+    # the list of candidate completions, last_metrics (per thread) describes the request that made them, and model
+    # and max_tokens are plain attributes. A backend that streams calls done(text) as a completion's text grows and
+    # may stop as soon as it returns True.
+    #
+    # With stream, completions arrive as server-sent events and the request is cut off (by closing the connection,
+    # the only way to cancel it) once done says the text is enough; only the completions that are finished or done
+    # are returned then, a cut-off one could parse as something it was not going to say.
+    def __init__(self, base_url="https://api.openai.com/v1", api_key=None, model="text-davinci-002", temperature=0.5,
+                 max_tokens=50, n=1, best_of=None, timeout=30, retries=3, backoff=0.5, stream=False):
+        url = urlsplit(base_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip("/") + "/completions"
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.n = n
+        self.best_of = best_of
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.stream = stream
+        self.local = threading.local()
+
+    @property
+    def last_metrics(self):
+        return getattr(self.local, "last_metrics", {})
+
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            self.local.connection = connection_class(self.host, self.port, timeout=self.timeout)
+        return self.local.connection
+
+    def disconnect(self):
+        if getattr(self.local, "connection", None) is not None:
+            self.local.connection.close()
+            self.local.connection = None
+
+    def request_body(self, prompt, max_tokens=None):
+        body = {
+            "model": self.model,
+            "prompt": prompt,
+            "temperature": self.temperature,
+            "max_tokens": max_tokens or self.max_tokens,
+        }
+        if self.n > 1:
+            body["n"] = self.n
+        if self.best_of is not None:
+            body["best_of"] = self.best_of
+        return body
+
+    def headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def post(self, body, stream=False):
+        # returns the decoded response (with stream, the response to read events from), raising CompletionError for
+        # answers that retrying will not fix
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * (1 + random.random()))
+            self.local.attempts = attempt + 1
+
+            try:
+                connection = self.connection()
+                connection.request("POST", self.path, body=json.dumps(body).encode(), headers=self.headers())
+                response = connection.getresponse()
+                if stream and response.status == 200:
+                    return response
+                payload = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                self.disconnect()
+                error = e
+                continue
+
+            if response.status == 200:
+                return json.loads(payload)
+            if response.will_close:
+                self.disconnect()
+
+            error = CompletionError(f"HTTP {response.status}: {payload[:200]!r}")
+            if response.status not in retryable_statuses:
+                raise error
+
+        raise CompletionError(f"giving up after {self.retries + 1} attempts: {error!r}")
+
+    @staticmethod
+    def events(response):
+        # the decoded data of each server-sent event, up to [DONE]
+        for line in iter(response.readline, b""):
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                # the rest of the body, so the connection can be reused
+                response.read()
+                return
+            yield json.loads(data)
+
+    def complete_streaming(self, prompt, max_tokens=None, done=None):
+        start = time.time()
+        texts = {}
+        finished = []
+        stopped = None
+        usage = {}
+        first_token = None
+        try:
+            response = self.post(dict(self.request_body(prompt, max_tokens), stream=True), stream=True)
+            try:
+                for event in self.events(response):
+                    if first_token is None:
+                        first_token = time.time() - start
+                    usage = event.get("usage") or usage
+                    for choice in event.get("choices", []):
+                        index = choice.get("index", 0)
+                        texts[index] = texts.get(index, "") + choice.get("text", "")
+                        if choice.get("finish_reason"):
+                            finished.append(index)
+                        elif done is not None and done(texts[index]):
+                            stopped = index
+                            break
+                    if stopped is not None:
+                        break
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                self.disconnect()
+                raise CompletionError(f"stream broken off: {e!r}")
+            if stopped is not None:
+                self.disconnect()
+        finally:
+            self.local.last_metrics = {
+                "latency": time.time() - start,
+                "attempts": self.local.attempts,
+                "first_token": first_token,
+                "stopped_early": stopped is not None,
+            }
+
+        if usage:
+            self.local.last_metrics["usage"] = usage
+            self.local.last_metrics["cached_tokens"] = cached_tokens(usage)
+        else:
+            # usage comes with the last event, which a stream stopped early never gets: count the prompt here and
+            # leave how much of it the server had cached unknown
+            self.local.last_metrics["usage"] = {"prompt_tokens": count_tokens(prompt), "estimated": True}
+            self.local.last_metrics["cached_tokens"] = None
+        if stopped is not None:
+            return [texts[stopped]] + [texts[index] for index in sorted(finished)]
+        return [texts[index] for index in sorted(texts)] or [""]
+
+    def complete(self, prompt, max_tokens=None, done=None):
+        if self.stream:
+            return self.complete_streaming(prompt, max_tokens, done)
+
+        start = time.time()
+        try:
+            response = self.post(self.request_body(prompt, max_tokens))
+        finally:
+            self.local.last_metrics = {
+                "latency": time.time() - start,
+                "attempts": self.local.attempts,
+            }
+
+        usage = response.get("usage", {})
+        self.local.last_metrics["usage"] = usage
+        self.local.last_metrics["cached_tokens"] = cached_tokens(usage)
+        choices = sorted(response["choices"], key=lambda choice: choice.get("index", 0))
+        return [choice["text"] for choice in choices]
@@ -7,21 +7,37 @@
 
 
 import os
-import time
 from sys import argv, exit
 
-import openai
+from playwright.sync_api import Error
 
+from commands import Click, CommandParseError, Scroll, Type, format_command, parse_command, parse_commands
+from compaction import compact
 from crawler import Crawler
-
-quiet = False
-if len(argv) >= 2:
-    if argv[1] == '-q' or argv[1] == '--quiet':
-        quiet = True
-        print(
-            "Running in quiet mode (HTML and other content hidden); \n"
-            + "exercise caution when running suggested commands."
-        )
+from llm import HTTPCompletionBackend
+from prompt import PromptTemplate
+from replay import Recorder
+from resources import AssetCache, ResourcePolicy, default_block_types
+from response_cache import ResponseCache
+from tracing import tracer
+
+# Set NATBOT_LLM_URL to point natbot at any OpenAI-compatible completions server, e.g. stub_server.py, and
+# NATBOT_STREAM=1 to stream answers and act on the first command as soon as its line is complete
+backend = HTTPCompletionBackend(
+    base_url=os.environ.get("NATBOT_LLM_URL", "https://api.openai.com/v1"),
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    model=os.environ.get("NATBOT_MODEL", "text-davinci-002"),
+    stream=os.environ.get("NATBOT_STREAM", "") not in ("", "0"),
+)
+
+# Set NATBOT_CACHE to a file path to share model responses across runs and processes
+response_cache = ResponseCache(os.environ["NATBOT_CACHE"]) if os.environ.get("NATBOT_CACHE") else None
+
+# tokens of browser content sent to the model per step
+browser_content_budget = 1200
+
+# how often an answer that is not a command is asked for again before giving up on the step
+reasks = 2
 
 prompt_template = """
 You are an agent controlling a browser. You are given:
@@ -161,11 +177,195 @@ PREVIOUS COMMAND: $previous_command
 YOUR COMMAND:
 """
 
+
+# In plan mode the model may answer with several commands; every command after the first only runs if the element
+# it refers to is still on the page after the previous one.
+plan_length = 3
+
+plan_instructions = f"""If you already know which elements your next few commands will use, for example when filling in several
+inputs of the same form and then clicking its submit button, you may issue up to {plan_length} commands, one per line.
+A command is skipped if its element is gone by the time it would run.
+
+"""
+
+# compiled once: the instructions and examples above are sent as an unchanging prefix
+compiled_prompt = PromptTemplate(prompt_template)
+compiled_plan_prompt = PromptTemplate(
+    prompt_template.replace("Based on your given objective", plan_instructions + "Based on your given objective", 1)
+)
+
+
+def answer_settled(text, limit):
+    # Whether more text can no longer change parse_commands(text, limit): `limit` commands are complete, or a
+    # complete line that is not a command ends the run. A line is complete once a newline ends it, or for CLICK and
+    # SCROLL as soon as the id or direction is followed by something ("CLICK 1" may still become "CLICK 12").
+    lines = text.lstrip().split("\n")
+    count = 0
+    for position, line in enumerate(lines):
+        complete = position < len(lines) - 1
+        try:
+            action = parse_command(line)
+        except CommandParseError:
+            return complete
+        if not complete and not (isinstance(action, (Click, Scroll)) and is_same_command(line + "0", action)):
+            return False
+        count += 1
+        if count >= limit:
+            return True
+    return False
+
+
+def is_same_command(text, action):
+    try:
+        return parse_command(text) == action
+    except CommandParseError:
+        return False
+
+
+def get_gpt_command(objective, url, previous_command, browser_content, plan=False):
+    # Returns the model's command, spelled canonically (several lines of them with plan), and metrics about how it
+    # was obtained. An answer that does not parse is re-asked right away, up to `reasks` times; if none parses the
+    # raw answer is returned and acting on it fails.
+    template = compiled_plan_prompt if plan else compiled_prompt
+
+    if response_cache is not None:
+        cache_key = response_cache.key(
+            objective, url, previous_command, browser_content, backend.model, template.prefix
+        )
+        with tracer.span("cache.get") as span:
+            cached = response_cache.get(cache_key)
+            span.set(hit=cached is not None)
+        if cached is not None:
+            return cached, {"cache_hit": True}
+
+    with tracer.span("prompt.build", prefix_tokens=template.prefix_tokens):
+        prompt = template.render(
+            browser_content=browser_content, objective=objective, url=url[:100], previous_command=previous_command
+        )
+    limit = plan_length if plan else 1
+    latency = 0
+    for attempt in range(reasks + 1):
+        with tracer.span("model", attempt=attempt, plan=plan) as span:
+            choices = backend.complete(
+                prompt, max_tokens=backend.max_tokens * limit, done=lambda text: answer_settled(text, limit)
+            )
+            span.set(**backend.last_metrics)
+        latency += backend.last_metrics["latency"]
+        metrics = dict(backend.last_metrics, latency=latency, reasks=attempt, cache_hit=False)
+
+        # with n > 1, take the first candidate that actually is a command
+        for choice in choices:
+            actions = parse_commands(choice, limit)
+            if actions:
+                command = "\n".join(format_command(action) for action in actions)
+                if response_cache is not None:
+                    response_cache.put(cache_key, command)
+                metrics["answer"] = choice
+                return command, metrics
+
+    metrics["answer"] = choices[0]
+    return choices[0], metrics
+
+
+def parse_plan(text, length=plan_length):
+    # the leading run of commands in text, at most `length` of them
+    return parse_commands(text, length)
+
+
+def remap_command(action, planned_elements, page_element_buffer):
+    # Moves action, aimed at the elements of an earlier crawl, onto the ids of the current one by matching backend
+    # node ids (node keys for the in-page extractor). Returns None if its element is not on the page anymore.
+    if isinstance(action, Scroll):
+        return action
+
+    element = planned_elements.get(action.id)
+    if element is None:
+        return None
+    node = element.backend_node_id, element.node_key
+    for id, candidate in page_element_buffer.items():
+        if (candidate.backend_node_id, candidate.node_key) == node:
+            return action._replace(id=id)
+    return None
+
+
+def settle_action(action):
+    # the settle policy for action
+    if isinstance(action, Scroll):
+        return "scroll"
+    if isinstance(action, Click):
+        return "click"
+    return "submit" if action.submit else "type"
+
+
+def dispatch(crawler, action):
+    # performs action and returns the seconds spent waiting for the page to settle
+    with tracer.span("action", command=format_command(action)):
+        if isinstance(action, Scroll):
+            crawler.scroll(action.direction)
+        elif isinstance(action, Click):
+            crawler.click(action.id)
+        elif isinstance(action, Type):
+            crawler.type(action.id, action.text + "\n" if action.submit else action.text)
+
+    return crawler.settle(settle_action(action))
+
+
+def run_cmd(crawler, cmd):
+    # returns the seconds spent waiting for the page to settle; raises CommandParseError without acting if cmd is
+    # not a command
+    return dispatch(crawler, parse_command(cmd))
+
+
+def run_plan(crawler, plan):
+    # Runs the actions of a plan back to back, re-crawling between them. Returns the actions that ran; when one no
+    # longer applies the rest of the plan is dropped and the model gets asked again.
+    planned_elements = dict(crawler.page_element_buffer)
+    executed = []
+
+    for position, action in enumerate(plan):
+        if position:
+            crawler.crawl()
+            action = remap_command(action, planned_elements, crawler.page_element_buffer)
+            if action is None:
+                break
+        dispatch(crawler, action)
+        executed.append(action)
+
+    return executed
+
+
 if (
         __name__ == "__main__"
 ):
-    _crawler = Crawler()
-    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    quiet = False
+    if '-q' in argv[1:] or '--quiet' in argv[1:]:
+        quiet = True
+        print(
+            "Running in quiet mode (HTML and other content hidden); \n"
+            + "exercise caution when running suggested commands."
+        )
+
+    # let the model suggest several commands at once (see plan_instructions)
+    plan = '-p' in argv[1:] or '--plan' in argv[1:]
+
+    # do not load images, media and fonts; NATBOT_ASSET_CACHE names a SQLite file to keep static assets in
+    resources = None
+    if '-b' in argv[1:] or '--block' in argv[1:] or os.environ.get("NATBOT_ASSET_CACHE"):
+        resources = ResourcePolicy(
+            block_types=default_block_types if '-b' in argv[1:] or '--block' in argv[1:] else (),
+            cache=AssetCache(os.environ["NATBOT_ASSET_CACHE"]) if os.environ.get("NATBOT_ASSET_CACHE") else None,
+        )
+
+    _crawler = Crawler(
+        # list the whole document instead of just the window (see Crawler)
+        full_page='-f' in argv[1:] or '--full-page' in argv[1:],
+        # filter the page in the page itself rather than transferring a DOMSnapshot (see extractor.py)
+        extractor="js" if '-j' in argv[1:] or '--js-extractor' in argv[1:] else "snapshot",
+        resources=resources,
+    )
+    # Set NATBOT_RECORD to a directory to save every crawl there as a fixture for replay.py
+    if os.environ.get("NATBOT_RECORD"):
+        _crawler.recorder = Recorder(os.environ["NATBOT_RECORD"])
 
 
     def print_help():
@@ -174,42 +374,6 @@ if (
             "(h) to view commands again\n(r/enter) to run suggested command\n(o) change objective"
         )
 
-    def get_gpt_command(objective, url, previous_command, browser_content):
-        prompt = prompt_template
-        prompt = prompt.replace("$objective", objective)
-        prompt = prompt.replace("$url", url[:100])
-        prompt = prompt.replace("$previous_command", previous_command)
-        prompt = prompt.replace("$browser_content", browser_content[:4500])
-        response = openai.Completion.create(model="text-davinci-002", prompt=prompt, temperature=0.5, best_of=10, n=3,
-                                            max_tokens=50)
-        return response.choices[0].text
-
-
-    def run_cmd(cmd):
-        cmd = cmd.split("\n")[0]
-
-        if cmd.startswith("SCROLL UP"):
-            _crawler.scroll("up")
-        elif cmd.startswith("SCROLL DOWN"):
-            _crawler.scroll("down")
-        elif cmd.startswith("CLICK"):
-            commasplit = cmd.split(",")
-            id = commasplit[0].split(" ")[1]
-            _crawler.click(id)
-        elif cmd.startswith("TYPE"):
-            spacesplit = cmd.split(" ")
-            id = spacesplit[1]
-            text = spacesplit[2:]
-            text = " ".join(text)
-            # Strip leading and trailing double quotes
-            text = text[1:-1]
-
-            if cmd.startswith("TYPESUBMIT"):
-                text += '\n'
-            _crawler.type(id, text)
-
-        time.sleep(2)
-
 
     objective = "Make a reservation for 2 at 7pm at bistro vida in menlo park"
     print("\nWelcome to natbot! What is your objective?")
@@ -222,9 +386,16 @@ if (
     _crawler.go_to_page("google.com")
     try:
         while True:
-            browser_content = "\n".join(_crawler.crawl())
+            try:
+                elements = _crawler.crawl()
+            except Error as e:
+                # the document was replaced during the crawl, e.g. by a navigation that outlasted settle
+                print(f"The page changed while crawling it ({e.message}), crawling again")
+                _crawler.settle("click")
+                continue
+            browser_content = "\n".join(compact(elements, browser_content_budget))
             prev_cmd = gpt_cmd
-            gpt_cmd = get_gpt_command(objective, _crawler.page.url, prev_cmd, browser_content)
+            gpt_cmd, _ = get_gpt_command(objective, _crawler.page.url, prev_cmd, browser_content, plan)
             gpt_cmd = gpt_cmd.strip()
 
             if not quiet:
@@ -236,25 +407,33 @@ if (
 
             command = input()
             if command == "r" or command == "":
-                run_cmd(gpt_cmd)
+                try:
+                    if plan:
+                        executed = run_plan(_crawler, parse_plan(gpt_cmd) or [parse_command(gpt_cmd)])
+                        gpt_cmd = format_command(executed[-1]) if executed else gpt_cmd
+                    else:
+                        run_cmd(_crawler, gpt_cmd)
+                except CommandParseError as e:
+                    # nothing was done, so the next round asks again for the same page
+                    print(f"Could not parse the suggested command ({e}), asking again")
             elif command == "g":
                 url = input("URL:")
                 _crawler.go_to_page(url)
             elif command == "u":
                 _crawler.scroll("up")
-                time.sleep(1)
+                _crawler.settle("scroll")
             elif command == "d":
                 _crawler.scroll("down")
-                time.sleep(1)
+                _crawler.settle("scroll")
             elif command == "c":
                 id = input("id:")
                 _crawler.click(id)
-                time.sleep(1)
+                _crawler.settle("click")
             elif command == "t":
                 id = input("id:")
                 text = input("text:")
                 _crawler.type(id, text)
-                time.sleep(1)
+                _crawler.settle("type")
             elif command == "o":
                 objective = input("Objective:")
             else:
@@ -0,0 +1,134 @@
+import asyncio
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+from playwright.async_api import async_playwright
+
+from crawler import AsyncCrawler
+
+
+class BrowserPool:
+    # Pre-launches `size` browsers and leases AsyncCrawlers, each in its own BrowserContext. Returned contexts are
+    # wiped (cookies, permissions and the storage of every origin they visited) and kept warm for the next task.
+    # The number of live contexts per browser is capped by memory: memory_per_browser_mb // memory_per_context_mb.
+    # `resources`, a resources.ResourcePolicy, is installed on every page.
+    def __init__(self, size=2, headless=True, memory_per_browser_mb=2048, memory_per_context_mb=256, max_uses=50,
+                 resources=None):
+        self.size = size
+        self.resources = resources
+        self.headless = headless
+        self.max_contexts_per_browser = max(1, memory_per_browser_mb // memory_per_context_mb)
+        self.max_uses = max_uses
+
+        self.playwright = None
+        self.browsers = []
+        self.live_contexts = {}
+        self.idle_crawlers = {}
+        self.uses = {}
+        self.visited_origins = {}
+        self.available = asyncio.Condition()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        self.playwright = await async_playwright().start()
+        self.browsers = list(await asyncio.gather(
+            *(self.playwright.chromium.launch(headless=self.headless) for _ in range(self.size))
+        ))
+        for browser in self.browsers:
+            self.live_contexts[browser] = 0
+            self.idle_crawlers[browser] = []
+
+    async def close(self):
+        await asyncio.gather(*(browser.close() for browser in self.browsers))
+        await self.playwright.stop()
+        self.browsers = []
+
+    def least_loaded_browser(self):
+        browser = min(self.browsers, key=lambda browser: self.live_contexts[browser], default=None)
+        if browser is None or self.live_contexts[browser] >= self.max_contexts_per_browser:
+            return None
+        return browser
+
+    async def acquire(self):
+        async with self.available:
+            await self.available.wait_for(lambda: self.least_loaded_browser() is not None)
+            browser = self.least_loaded_browser()
+            self.live_contexts[browser] += 1
+
+        try:
+            if self.idle_crawlers[browser]:
+                crawler = self.idle_crawlers[browser].pop()
+            else:
+                crawler = await AsyncCrawler.create(browser, self.resources)
+                self.track_origins(crawler)
+        except Exception:
+            await self.give_back(browser)
+            raise
+
+        return crawler
+
+    async def release(self, crawler):
+        browser = crawler.browser
+        self.uses[crawler] = self.uses.get(crawler, 0) + 1
+
+        try:
+            if self.uses[crawler] >= self.max_uses or crawler.page.is_closed():
+                await self.discard(crawler)
+            else:
+                await self.wipe(crawler)
+                self.idle_crawlers[browser].append(crawler)
+        except Exception:
+            await self.discard(crawler)
+        finally:
+            await self.give_back(browser)
+
+    @asynccontextmanager
+    async def lease(self):
+        crawler = await self.acquire()
+        try:
+            yield crawler
+        finally:
+            await self.release(crawler)
+
+    async def give_back(self, browser):
+        async with self.available:
+            self.live_contexts[browser] -= 1
+            self.available.notify()
+
+    def track_origins(self, crawler):
+        origins = self.visited_origins[crawler] = set()
+
+        def on_navigated(frame):
+            url = urlsplit(frame.url)
+            if url.scheme in ("http", "https"):
+                origins.add(f"{url.scheme}://{url.netloc}")
+
+        crawler.page.on("framenavigated", on_navigated)
+
+    async def wipe(self, crawler):
+        page = crawler.page
+        await page.goto("about:blank")
+
+        client = await page.context.new_cdp_session(page)
+        origins = self.visited_origins[crawler]
+        for origin in origins:
+            await client.send("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        origins.clear()
+        await client.detach()
+
+        await page.context.clear_cookies()
+        await page.context.clear_permissions()
+
+    async def discard(self, crawler):
+        self.uses.pop(crawler, None)
+        self.visited_origins.pop(crawler, None)
+        try:
+            await crawler.close()
+        except Exception:
+            pass
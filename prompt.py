@@ -0,0 +1,23 @@
+import re
+
+from compaction import count_tokens
+
+field_pattern = re.compile(r"\$([A-Za-z_]\w*)")
+
+
+class PromptTemplate:
+    # Splits a $field template once into literal text and field names. Everything before the first field is a
+    # static prefix that is byte-identical on every render, so servers with prefix (KV) caching can reuse it.
+    def __init__(self, template):
+        pieces = field_pattern.split(template)
+        self.prefix = pieces[0]
+        self.prefix_tokens = count_tokens(self.prefix)
+        self.fields = pieces[1::2]
+        self.literals = pieces[2::2]
+
+    def render(self, **values):
+        parts = [self.prefix]
+        for field, literal in zip(self.fields, self.literals):
+            parts.append(values[field])
+            parts.append(literal)
+        return "".join(parts)
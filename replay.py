@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# replay.py
+#
+# Record what crawl saw and replay it without a browser. A fixture is the raw DOMSnapshot.captureSnapshot payload
+# plus the viewport state it was culled against; replaying runs the same flattening and rendering as Crawler.crawl.
+#
+#   NATBOT_RECORD=fixtures python natbot.py
+#   python replay.py fixtures/*.json.gz --golden golden --update   # write the expected output once
+#   python replay.py fixtures/*.json.gz --golden golden            # time the pipeline and compare against it
+#
+# --compare needs a browser instead: it crawls live pages with both extractors and diffs what they render.
+#
+#   python replay.py --compare news.ycombinator.com en.wikipedia.org/wiki/Python
+#
+
+import argparse
+import difflib
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from crawler import Crawler
+from snapshot import ColumnarSnapshot, render_snapshot, viewport_bounds
+
+
+def open_fixture(path, mode):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+def save_fixture(path, url, viewport_state, tree, full_page=False, scroll_delta=(0, 0)):
+    # scroll_delta is how far the window had scrolled since the snapshot was captured, for crawls that reused it
+    fixture = {
+        "url": url,
+        "viewport_state": viewport_state,
+        "full_page": full_page,
+        "scroll_delta": list(scroll_delta),
+        "platform": sys.platform,
+        "snapshot": tree,
+    }
+    with open_fixture(path, "wt") as f:
+        json.dump(fixture, f)
+
+
+def load_fixture(path):
+    with open_fixture(path, "rt") as f:
+        return json.load(f)
+
+
+class Recorder:
+    # Set as Crawler.recorder (or AsyncCrawler.recorder) to save every crawl as a fixture in `directory`, named
+    # <prefix><number>.json.gz. Crawls that reuse the cached snapshot are saved with that snapshot.
+    def __init__(self, directory, prefix=""):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.count = 0
+        self.tree = None
+
+    def snapshot(self, tree):
+        self.tree = tree
+
+    def crawl(self, url, viewport_state, full_page=False, scroll_delta=(0, 0)):
+        path = os.path.join(self.directory, f"{self.prefix}{self.count:04d}.json.gz")
+        self.count += 1
+        save_fixture(path, url, viewport_state, self.tree, full_page, scroll_delta)
+
+
+def replay(fixture):
+    # the crawl output for a fixture and the page_element_buffer it filled
+    page_element_buffer = {}
+    snapshot = ColumnarSnapshot(fixture["snapshot"])
+    elements = render_snapshot(
+        snapshot, *viewport_bounds(fixture["viewport_state"], fixture.get("platform", sys.platform)),
+        page_element_buffer, fixture.get("full_page", False), fixture.get("scroll_delta", (0, 0))
+    )
+    return elements, page_element_buffer
+
+
+def golden_record(elements, page_element_buffer):
+    # what a golden file pins down: the rendered elements and where each id points
+    return {
+        "elements": elements,
+        "targets": [
+            [id, element.backend_node_id, element.center_x, element.center_y]
+            for id, element in sorted(page_element_buffer.items())
+        ],
+    }
+
+
+def measure(run, repeat):
+    # (best seconds, peak traced bytes, result) for run(); memory is traced in a separate run so it does not skew
+    # the timings
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(timings), peak, result
+
+
+def compare_extractors(crawler, url):
+    # (snapshot crawl, js crawl, whether the page held still) for url. The snapshot crawl is repeated after the js
+    # one; if the two differ, the page changed in between and so may the comparison.
+    #
+    # Known differences, besides those listed in extractor.py: only the snapshot sees pseudo-element nodes
+    # (::marker, ::before, ::after). ::marker is black-listed and the others have no node value, so they render
+    # nothing, but the snapshot counts them and the text CSS generates through them is missing from both.
+    crawler.go_to_page(url)
+    crawler.settle("click")
+    snapshot_elements = crawler.crawl(extractor="snapshot")
+    js_elements = crawler.crawl(extractor="js")
+    return snapshot_elements, js_elements, crawler.crawl(extractor="snapshot") == snapshot_elements
+
+
+def check_golden(path, record, update):
+    # "match", "MISMATCH", "written" or "no golden"
+    if update:
+        with open(path, "w") as f:
+            json.dump(record, f, indent=1)
+        return "written"
+    if not os.path.exists(path):
+        return "no golden"
+    with open(path) as f:
+        return "match" if json.load(f) == json.loads(json.dumps(record)) else "MISMATCH"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded snapshots through the crawl pipeline")
+    parser.add_argument("fixtures", nargs="*", help="fixture files (.json or .json.gz)")
+    parser.add_argument("--golden", help="directory of golden outputs, one <fixture name>.golden.json per fixture")
+    parser.add_argument("--update", action="store_true", help="write the golden outputs instead of comparing")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--compare", nargs="+", metavar="URL",
+                        help="crawl these pages with the snapshot and the js extractor and diff the output")
+    parser.add_argument("--full-page", action="store_true", help="with --compare, crawl whole documents")
+    args = parser.parse_args()
+    if not args.fixtures and not args.compare:
+        parser.error("give fixtures or --compare")
+
+    if args.compare:
+        crawler = Crawler(headless=True, full_page=args.full_page)
+        differences = 0
+        for url in args.compare:
+            snapshot_elements, js_elements, stable = compare_extractors(crawler, url)
+            diff = list(difflib.unified_diff(snapshot_elements, js_elements, "snapshot", "js", lineterm=""))
+            status = "match" if not diff else "DIFFERENT" if stable else "different, but the page kept changing"
+            print(f"{url}: {len(snapshot_elements)} snapshot elements, {len(js_elements)} js elements, {status}")
+            for line in diff:
+                print("    " + line)
+            differences += bool(diff) and stable
+        if differences:
+            raise SystemExit(1)
+        raise SystemExit(0)
+
+    if args.golden:
+        os.makedirs(args.golden, exist_ok=True)
+
+    mismatches = 0
+    for path in args.fixtures:
+        fixture = load_fixture(path)
+        seconds, peak, (elements, page_element_buffer) = measure(lambda: replay(fixture), args.repeat)
+        nodes = sum(len(document["nodes"]["nodeName"]) for document in fixture["snapshot"]["documents"])
+
+        status = ""
+        if args.golden:
+            name = os.path.basename(path).split(".")[0]
+            status = check_golden(
+                os.path.join(args.golden, name + ".golden.json"), golden_record(elements, page_element_buffer),
+                args.update,
+            )
+            mismatches += status == "MISMATCH"
+
+        print("{}: {} nodes, {} elements, best {:0.4f}s, {:0.2f}M nodes/s, peak {:0.1f}MB {}".format(
+            path, nodes, len(elements), seconds, nodes / seconds / 1e6, peak / 2 ** 20, status
+        ))
+
+    if mismatches:
+        raise SystemExit(1)
@@ -0,0 +1,311 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from functools import partial
+from urllib.parse import urlsplit
+
+from playwright.async_api import Error as AsyncError
+from playwright.sync_api import Error
+
+# Nothing a crawl shows the model comes out of these: images contribute their alt text, which is in the DOM anyway.
+default_block_types = frozenset(["image", "media", "font"])
+# assets worth keeping across pages and sessions
+default_cache_types = frozenset(["script", "stylesheet", "image", "font"])
+# headers that describe the transfer rather than the body, and would be wrong for a body served from the cache
+hop_headers = frozenset(["connection", "content-encoding", "content-length", "keep-alive", "transfer-encoding"])
+# what the route handlers catch, whichever API raised it
+page_errors = (Error, AsyncError)
+# the DevTools protocol's names for playwright's resource types, which are the same lowercased
+cdp_resource_types = {
+    name.lower(): name
+    for name in (
+        "Document", "Stylesheet", "Image", "Media", "Font", "Script", "TextTrack", "XHR", "Fetch", "Prefetch",
+        "EventSource", "WebSocket", "Manifest", "SignedExchange", "Ping", "CSPViolationReport", "Preflight", "Other",
+    )
+}
+max_age_pattern = re.compile(r"(?:s-maxage|max-age)\s*=\s*(\d+)", re.I)
+# Cache-Control directives that rule out serving the response without asking the server
+uncacheable_directives = ("no-store", "no-cache", "private")
+
+
+def read_domains(path):
+    # one domain per line, # starts a comment
+    with open(path) as f:
+        return [line.split("#")[0].strip().lower() for line in f if line.split("#")[0].strip()]
+
+
+def http_date(value):
+    # seconds since the epoch for an HTTP date header, None if it is missing or does not parse
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def new_stats():
+    return {"requests": 0, "blocked_requests": 0, "blocked_bytes": 0, "cache_hits": 0, "cache_bytes": 0}
+
+
+class AssetCache:
+    # Static assets by URL in SQLite, shared by every browser and process pointed at the same file. Responses are
+    # kept for as long as their Cache-Control max-age or Expires header allows; without either, for a tenth of the
+    # time since Last-Modified (the usual heuristic), at most `ttl`, and not at all without that. Nothing is ever
+    # revalidated, so what must be is not stored. The least recently used responses are evicted beyond `max_bytes`
+    # of bodies.
+    def __init__(self, path, ttl=24 * 3600, max_bytes=512 * 2 ** 20):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS assets (url TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, "
+            "size INTEGER, expires REAL, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS assets_accessed ON assets (accessed)")
+
+    def get(self, url):
+        # (status, headers, body), or None if the asset is missing or expired
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status, headers, body, expires FROM assets WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            status, headers, body, expires = row
+            if now > expires:
+                self.connection.execute("DELETE FROM assets WHERE url = ?", (url,))
+                return None
+
+            self.connection.execute("UPDATE assets SET accessed = ? WHERE url = ?", (now, url))
+        return status, json.loads(headers), body
+
+    def size(self, url):
+        # the size of the asset's body if it is (or was) cached, else 0
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM assets WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else 0
+
+    def lifetime(self, headers, now=None):
+        # seconds the response may be reused for, 0 if it must not be stored
+        cache_control = headers.get("cache-control", "").lower()
+        if any(directive in cache_control for directive in uncacheable_directives) or "set-cookie" in headers:
+            return 0
+        max_age = max_age_pattern.search(cache_control)
+        if max_age:
+            return int(max_age.group(1))
+
+        now = time.time() if now is None else now
+        date = http_date(headers.get("date")) or now
+        if "expires" in headers:
+            # an Expires that does not parse means already expired
+            expires = http_date(headers["expires"])
+            return max(0, int(expires - date)) if expires else 0
+        last_modified = http_date(headers.get("last-modified"))
+        if last_modified:
+            return min(self.ttl, max(0, int((date - last_modified) / 10)))
+        return 0
+
+    def put(self, url, status, headers, body):
+        lifetime = self.lifetime(headers)
+        if status != 200 or not lifetime:
+            return False
+
+        now = time.time()
+        headers = json.dumps({key: value for key, value in headers.items() if key not in hop_headers})
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO assets (url, status, headers, body, size, expires, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (url, status, headers, body, len(body), now + lifetime, now),
+                )
+                self.connection.execute("DELETE FROM assets WHERE expires < ?", (now,))
+                (total,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM assets").fetchone()
+                if total > self.max_bytes:
+                    for old_url, size in self.connection.execute(
+                        "SELECT url, size FROM assets ORDER BY accessed"
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        self.connection.execute("DELETE FROM assets WHERE url = ?", (old_url,))
+                        total -= size
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return True
+
+
+class ResourcePolicy:
+    # Decides, per request, whether the browser loads it at all: requests of a blocked resource type or to a
+    # blocked domain (or any of its subdomains) are aborted, main-frame navigations never are. With an AssetCache,
+    # GETs of cache_types are served from it when possible and stored in it otherwise.
+    #
+    # There are two ways to install it. route()/route_async() go through a playwright route and can do everything,
+    # but playwright turns the browser's HTTP cache off for a routed page, so whatever the AssetCache does not keep
+    # (documents, XHRs, assets that say nothing about their freshness) is downloaded again on every load.
+    # intercept()/intercept_async() only block, through the DevTools protocol, and leave the HTTP cache alone; they
+    # do not reach the requests of out-of-process iframes (a blocked domain's frame is still blocked as a whole).
+    #
+    # Counters go into the `stats` dict handed to the installing method; Crawler keeps one per page and counts the
+    # requests itself. blocked_bytes can only count what is known without loading the request, i.e. the sizes of
+    # blocked assets the cache has seen.
+    def __init__(self, block_types=default_block_types, block_domains=(), cache=None,
+                 cache_types=default_cache_types):
+        self.block_types = frozenset(block_types)
+        self.block_domains = frozenset(domain.lower().lstrip(".") for domain in block_domains)
+        self.cache = cache
+        self.cache_types = frozenset(cache_types)
+
+    def blocked_domain(self, url):
+        host = (urlsplit(url).hostname or "").lower()
+        while host:
+            if host in self.block_domains:
+                return True
+            host = host.partition(".")[2]
+        return False
+
+    def blocks_request(self, url, resource_type, main_frame_navigation):
+        if main_frame_navigation:
+            return False
+        return resource_type in self.block_types or self.blocked_domain(url)
+
+    def blocks(self, request):
+        main_frame_navigation = request.is_navigation_request() and request.frame.parent_frame is None
+        return self.blocks_request(request.url, request.resource_type, main_frame_navigation)
+
+    def cacheable(self, request):
+        return self.cache is not None and request.method == "GET" and request.resource_type in self.cache_types
+
+    def handle_steps(self, route, stats):
+        # What route() and route_async() do with a request, as a generator of (blocking, call) pairs: each call is
+        # made by the handler, which sends back its result or throws in its playwright Error. Blocking calls are the
+        # ones into the cache, which route_async makes in a thread: SQLite can wait up to its busy timeout for
+        # another process's write, and the event loop is shared by every session of a pool.
+        request = route.request
+        if self.blocks(request):
+            stats["blocked_requests"] += 1
+            if self.cache is not None:
+                stats["blocked_bytes"] += yield True, partial(self.cache.size, request.url)
+            yield False, partial(route.abort, "blockedbyclient")
+            return
+        if not self.cacheable(request):
+            yield False, route.continue_
+            return
+
+        cached = yield True, partial(self.cache.get, request.url)
+        if cached is not None:
+            status, headers, body = cached
+            stats["cache_hits"] += 1
+            stats["cache_bytes"] += len(body)
+            yield False, partial(route.fulfill, status=status, headers=headers, body=body)
+            return
+        try:
+            response = yield False, route.fetch
+            body = yield False, response.body
+        except page_errors:
+            yield False, route.continue_
+            return
+        yield True, partial(self.cache.put, request.url, response.status, response.headers, body)
+        yield False, partial(route.fulfill, response=response, body=body)
+
+    def route(self, target, stats):
+        # installs the policy on a playwright.sync_api Page or BrowserContext
+        target.route("**/*", lambda route: drive(self.handle_steps(route, stats)))
+
+    async def route_async(self, target, stats):
+        # installs the policy on a playwright.async_api Page or BrowserContext
+        async def handle(route):
+            await drive_async(self.handle_steps(route, stats))
+
+        await target.route("**/*", handle)
+
+    def intercept_patterns(self):
+        # Fetch.enable patterns for the requests blocking may apply to; the domain patterns can match more than the
+        # domain (a * also matches "/" and "?"), paused_steps decides
+        patterns = [
+            {"resourceType": cdp_resource_types[resource_type], "requestStage": "Request"}
+            for resource_type in sorted(self.block_types) if resource_type in cdp_resource_types
+        ]
+        for domain in sorted(self.block_domains):
+            for host in (domain, "*." + domain):
+                for url_pattern in (f"*://{host}/*", f"*://{host}:*"):
+                    patterns.append({"urlPattern": url_pattern, "requestStage": "Request"})
+        return patterns
+
+    def paused_steps(self, session, event, main_frame_id, stats):
+        # what intercept() and intercept_async() do with a Fetch.requestPaused event, in the form of handle_steps
+        main_frame_navigation = event["resourceType"] == "Document" and event.get("frameId") == main_frame_id
+        request_id = {"requestId": event["requestId"]}
+        try:
+            if self.blocks_request(event["request"]["url"], event["resourceType"].lower(), main_frame_navigation):
+                yield False, partial(session.send, "Fetch.failRequest", dict(request_id, errorReason="BlockedByClient"))
+                stats["blocked_requests"] += 1
+            else:
+                yield False, partial(session.send, "Fetch.continueRequest", request_id)
+        except page_errors:
+            # the request went away in the meantime, e.g. with the document that made it
+            pass
+
+    def intercept(self, session, stats):
+        # Installs blocking (not the cache) on a playwright.sync_api CDPSession of a page. Unlike a route, this leaves
+        # the browser's HTTP cache on, and only the requests that may be blocked are paused at all. The main frame's
+        # id is its target's id.
+        patterns = self.intercept_patterns()
+        if not patterns:
+            return
+        main_frame_id = session.send("Target.getTargetInfo")["targetInfo"]["targetId"]
+        session.on("Fetch.requestPaused", lambda event: drive(self.paused_steps(session, event, main_frame_id, stats)))
+        session.send("Fetch.enable", {"patterns": patterns})
+
+    async def intercept_async(self, session, stats):
+        # intercept() for a playwright.async_api CDPSession
+        patterns = self.intercept_patterns()
+        if not patterns:
+            return
+        main_frame_id = (await session.send("Target.getTargetInfo"))["targetInfo"]["targetId"]
+
+        async def handle(event):
+            await drive_async(self.paused_steps(session, event, main_frame_id, stats))
+
+        session.on("Fetch.requestPaused", handle)
+        await session.send("Fetch.enable", {"patterns": patterns})
+
+
+def drive(steps):
+    # carries out the calls of a handle_steps/paused_steps generator with the sync API
+    value = error = None
+    while True:
+        try:
+            _, step = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration:
+            return
+        value = error = None
+        try:
+            value = step()
+        except page_errors as e:
+            error = e
+
+
+async def drive_async(steps):
+    # carries out the calls of a handle_steps/paused_steps generator with the async API, blocking ones in a thread
+    value = error = None
+    while True:
+        try:
+            blocking, step = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration:
+            return
+        value = error = None
+        try:
+            value = await asyncio.to_thread(step) if blocking else await step()
+        except page_errors as e:
+            error = e
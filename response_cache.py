@@ -0,0 +1,79 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+
+def normalize_url(url):
+    url = urlsplit(url.strip())
+    return urlunsplit((url.scheme.lower(), url.netloc.lower(), url.path.rstrip("/"), url.query, ""))
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    # An on-disk LRU of model responses in SQLite, so any number of processes can share it. Entries expire after
+    # `ttl` seconds and the least recently used ones are evicted beyond `max_entries`.
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=50000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, created REAL, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def key(objective, url, previous_command, browser_content, *context):
+        # `context` is anything else the answer depends on, e.g. the model and the prompt prefix
+        normalized = [
+            normalize_text(objective).lower(),
+            normalize_url(url),
+            normalize_text(previous_command),
+            hashlib.sha256(browser_content.encode()).hexdigest(),
+            *context,
+        ]
+        return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            response, created = row
+            if now - created > self.ttl:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return response
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, response, now, now),
+                )
+                self.connection.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                (count,) = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+                if count > self.max_entries:
+                    self.connection.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
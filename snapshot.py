@@ -0,0 +1,480 @@
+import sys
+from itertools import chain
+
+import numpy as np
+
+from tracing import tracer
+
+black_listed_elements = {"html", "head", "title", "meta", "iframe", "body", "script", "style", "path", "svg", "br",
+                         "::marker"}
+# the attributes shown to the model, in the order they are looked for
+attribute_keys = ("type", "placeholder", "aria-label", "title", "alt")
+
+
+class Element:
+    # One crawled element, as kept in page_element_buffer under the id the model sees. backend_node_id comes from
+    # a DOMSnapshot crawl, node_key from the in-page extractor; the other is None.
+    __slots__ = ("node_index", "backend_node_id", "node_key", "node_name", "node_value", "node_meta", "is_clickable",
+                 "origin_x", "origin_y", "center_x", "center_y", "scroll_y")
+
+    def __init__(self, node_index, backend_node_id, node_key, node_name, node_value, node_meta, is_clickable,
+                 origin_x, origin_y, center_x, center_y, scroll_y):
+        self.node_index = node_index
+        self.backend_node_id = backend_node_id
+        self.node_key = node_key
+        self.node_name = node_name
+        self.node_value = node_value
+        self.node_meta = node_meta
+        self.is_clickable = is_clickable
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.center_x = center_x
+        self.center_y = center_y
+        self.scroll_y = scroll_y
+
+    def __repr__(self):
+        return "Element({})".format(", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__))
+
+
+def convert_name(node_name, has_click_handler):
+    if node_name == "a":
+        return "link"
+    if node_name == "input":
+        return "input"
+    if node_name == "img":
+        return "img"
+    if (
+            node_name == "button" or has_click_handler
+    ):  # found pages that needed this quirk
+        return "button"
+    else:
+        return "text"
+
+
+def string_ids(strings, wanted):
+    # {string id: string} for every entry of the string table that is one of `wanted`
+    ids = {}
+    for string in wanted:
+        start = 0
+        while True:
+            try:
+                start = strings.index(string, start)
+            except ValueError:
+                break
+            ids[start] = string
+            start += 1
+    return ids
+
+
+def find_attributes(attributes, key_ids, strings):
+    # the first value of each wanted attribute; key_ids maps the string ids of the wanted keys to the keys, so only
+    # the values that are kept get decoded
+    values = {}
+
+    for key_index, value_index in zip(*(iter(attributes),) * 2):
+        key = key_ids.get(key_index)
+        if key is None or value_index < 0 or key in values:
+            continue
+        values[key] = strings[value_index]
+
+    return values
+
+
+def nearest_ancestors(parent, marks):
+    # For every node, the index of the nearest ancestor-or-self carrying each mark (-1 if none). Works by pointer
+    # jumping over the parent array, so it needs O(log depth) array passes, no recursion and no assumption that
+    # parents come before their children.
+    node_count = len(parent)
+    nearest = np.where(marks, np.arange(node_count), -1)
+    jump = np.broadcast_to(parent, marks.shape).copy()
+    rows, cols = np.nonzero((nearest < 0) & (jump >= 0))
+
+    while len(rows):
+        target = jump[rows, cols]
+        found = nearest[rows, target]
+        resolved = found >= 0
+        nearest[rows[resolved], cols[resolved]] = found[resolved]
+
+        rows, cols, target = rows[~resolved], cols[~resolved], target[~resolved]
+        jump[rows, cols] = jump[rows, target]
+        still_pending = jump[rows, cols] >= 0
+        rows, cols = rows[still_pending], cols[still_pending]
+
+    return nearest
+
+
+def viewport_bounds(viewport_state, platform=sys.platform):
+    device_pixel_ratio = viewport_state["device_pixel_ratio"]
+    if platform == "darwin" and device_pixel_ratio == 1:  # lies
+        device_pixel_ratio = 2
+
+    win_upper_bound = viewport_state["page_y_offset"]
+    win_left_bound = viewport_state["page_x_offset"]
+    win_width = viewport_state["screen_width"]
+    win_height = viewport_state["screen_height"]
+    win_right_bound = win_left_bound + win_width
+    win_lower_bound = win_upper_bound + win_height
+
+    return device_pixel_ratio, win_left_bound, win_upper_bound, win_right_bound, win_lower_bound
+
+
+def first_layout(layout, node_count):
+    # Scatters a document's layout table onto its nodes; the first layout entry of a node wins. position is the
+    # string id of the node's computed position style, -1 if the capture did not ask for it.
+    layout_node_index, first_cursor = np.unique(np.asarray(layout["nodeIndex"], dtype=np.int64), return_index=True)
+    layout_bounds = np.asarray(layout["bounds"], dtype=np.float64).reshape(-1, 4)
+    has_layout = np.zeros(node_count, dtype=bool)
+    has_layout[layout_node_index] = True
+    bounds = np.zeros((node_count, 4), dtype=np.float64)
+    bounds[layout_node_index] = layout_bounds[first_cursor]
+    position = np.full(node_count, -1, dtype=np.int64)
+    # one string id per requested style and layout entry; chained rather than converted as nested lists, which is
+    # several times slower
+    styles = np.fromiter(chain.from_iterable(layout.get("styles") or ()), dtype=np.int64)
+    if len(styles) and len(layout_bounds):
+        position[layout_node_index] = styles.reshape(len(layout_bounds), -1)[first_cursor, 0]
+    return has_layout, bounds, position
+
+
+class ColumnarSnapshot:
+    # The documents of a captureSnapshot result (the page and its same-process frames; shadow trees are already
+    # flattened into them) concatenated into one set of node columns, so node indexes are unique across frames.
+    # Bounds are moved into the coordinates of the top document, and every node keeps the rect of the frames it is
+    # in as a clip.
+    def __init__(self, tree):
+        strings = tree["strings"]
+        documents = tree["documents"]
+        sizes = [len(document["nodes"]["nodeName"]) for document in documents]
+        starts = np.cumsum([0] + sizes[:-1]).tolist()
+
+        self.strings = strings
+        self.node_count = sum(sizes)
+        self.node_names = np.concatenate(
+            [np.asarray(document["nodes"]["nodeName"], dtype=np.int64) for document in documents]
+        )
+        self.parent = np.concatenate([
+            np.where(parent >= 0, parent + start, -1)
+            for parent, start in zip(
+                (np.asarray(document["nodes"]["parentIndex"], dtype=np.int64) for document in documents), starts
+            )
+        ])
+        self.document_of = np.repeat(np.arange(len(documents)), sizes)
+
+        # per-node python lists, only ever read for the nodes that survive culling
+        self.node_value = []
+        self.backend_node_id = []
+        self.attributes = []
+        self.input_value_of = {}
+        clickable = []
+        for document, start in zip(documents, starts):
+            nodes = document["nodes"]
+            self.node_value.extend(nodes["nodeValue"])
+            self.backend_node_id.extend(nodes["backendNodeId"])
+            self.attributes.extend(nodes["attributes"])
+            input_value = nodes["inputValue"]
+            self.input_value_of.update(
+                (index + start, value) for index, value in zip(input_value["index"], input_value["value"])
+            )
+            clickable.append(np.asarray(nodes["isClickable"]["index"], dtype=np.int64) + start)
+
+        self.is_clickable = np.zeros(self.node_count, dtype=bool)
+        self.is_clickable[np.concatenate(clickable)] = True
+
+        # resolve node names once per distinct string id instead of once per node
+        self.lower_names = {
+            name_index: strings[name_index].lower() for name_index in np.unique(self.node_names).tolist()
+        }
+        black_listed_ids = [
+            name_index for name_index, name in self.lower_names.items() if name in black_listed_elements
+        ]
+        self.is_black_listed = np.isin(self.node_names, black_listed_ids)
+        self.attribute_key_ids = string_ids(strings, attribute_keys)
+
+        self.has_layout = np.zeros(self.node_count, dtype=bool)
+        self.bounds = np.zeros((self.node_count, 4), dtype=np.float64)
+        position = np.full(self.node_count, -1, dtype=np.int64)
+        # x0, y0, x1, y1 of the frame each document is shown in; the top document is not clipped
+        self.clip = np.tile([-np.inf, -np.inf, np.inf, np.inf], (len(documents), 1))
+
+        # frames are placed parents first: a document's offset is its iframe's position minus its own scroll offset
+        embedded_in = {}
+        for document_index, document in enumerate(documents):
+            content_documents = document["nodes"].get("contentDocumentIndex", {"index": [], "value": []})
+            for node_index, content_document in zip(content_documents["index"], content_documents["value"]):
+                embedded_in[content_document] = starts[document_index] + node_index
+
+        queue = [document_index for document_index in range(len(documents)) if document_index not in embedded_in]
+        placed = set(queue)
+        children = {}
+        for content_document, frame_node in embedded_in.items():
+            children.setdefault(int(self.document_of[frame_node]), []).append(content_document)
+        for document_index in queue:
+            document = documents[document_index]
+            start = starts[document_index]
+            has_layout, bounds, position[start:start + sizes[document_index]] = first_layout(
+                document["layout"], sizes[document_index]
+            )
+
+            if document_index in embedded_in:
+                frame_node = embedded_in[document_index]
+                if self.has_layout[frame_node]:
+                    x, y, width, height = self.bounds[frame_node]
+                    parent_clip = self.clip[self.document_of[frame_node]]
+                    self.clip[document_index] = [
+                        max(x, parent_clip[0]), max(y, parent_clip[1]),
+                        min(x + width, parent_clip[2]), min(y + height, parent_clip[3]),
+                    ]
+                    bounds[:, 0] += x - document.get("scrollOffsetX", 0)
+                    bounds[:, 1] += y - document.get("scrollOffsetY", 0)
+                else:
+                    # the frame itself is not rendered, so nothing in it is
+                    self.clip[document_index] = [np.inf, np.inf, -np.inf, -np.inf]
+
+            self.has_layout[start:start + sizes[document_index]] = has_layout
+            self.bounds[start:start + sizes[document_index]] = bounds
+
+            for child in children.get(document_index, []):
+                if child not in placed:
+                    placed.add(child)
+                    queue.append(child)
+
+        # documents caught in an embedding cycle have nowhere to be shown
+        for document_index in range(len(documents)):
+            if document_index not in placed:
+                self.clip[document_index] = [np.inf, np.inf, -np.inf, -np.inf]
+
+        # Nodes that stay put on the screen while the window scrolls: position: fixed nodes of the top document, their
+        # descendants, and everything in frames among those. cull moves them by how far the window scrolled since
+        # the capture. Sticky nodes move by an amount the snapshot cannot tell, so scrolling makes it stale
+        # (scroll_dependent). Both need the capture to ask for the position style; without it, neither is ever set.
+        is_fixed = np.isin(position, list(string_ids(strings, ["fixed"])))
+        is_fixed &= np.isin(self.document_of, [index for index in range(len(documents)) if index not in embedded_in])
+        self.scroll_dependent = bool(np.isin(position, list(string_ids(strings, ["sticky"]))).any())
+
+        # even if an anchor is nested in another anchor, the "root" for all its descendants is the inner one. Fixed
+        # nodes go through the same pointer jumping when there are any, which costs far less than a pass of their own.
+        ancestor_tags = ("a", "button")
+        marks = [
+            np.isin(self.node_names, [name_index for name_index, name in self.lower_names.items() if name == tag])
+            for tag in ancestor_tags
+        ]
+        if is_fixed.any():
+            marks.append(is_fixed)
+        nearest = nearest_ancestors(self.parent, np.stack(marks))
+        self.anchor_ancestor, self.button_ancestor = nearest[:2]
+        self.fixed = nearest[2] >= 0 if len(nearest) > 2 else is_fixed
+        self.fixed_documents = np.zeros(len(documents), dtype=bool)
+        for document_index in queue:
+            if document_index in embedded_in and self.fixed[embedded_in[document_index]]:
+                self.fixed_documents[document_index] = True
+                self.fixed[starts[document_index]:starts[document_index] + sizes[document_index]] = True
+        self.has_fixed = bool(self.fixed.any())
+
+    def cull(self, device_pixel_ratio, win_left_bound, win_upper_bound, win_right_bound, win_lower_bound,
+             scroll_delta=(0, 0)):
+        # scroll_delta is how far the window scrolled since the capture
+        bounds = self.bounds / device_pixel_ratio
+        x = bounds[:, 0]
+        y = bounds[:, 1]
+        width = bounds[:, 2]
+        height = bounds[:, 3]
+        clip = self.clip / device_pixel_ratio
+        if self.has_fixed and any(scroll_delta):
+            delta_x, delta_y = scroll_delta
+            x[self.fixed] += delta_x
+            y[self.fixed] += delta_y
+            clip[self.fixed_documents] += [delta_x, delta_y, delta_x, delta_y]
+
+        partially_is_in_viewport = (
+                (x < win_right_bound)
+                & (x + width >= win_left_bound)
+                & (y < win_lower_bound)
+                & (y + height >= win_upper_bound)
+        )
+        if len(self.clip) > 1:
+            clip = clip[self.document_of]
+            partially_is_in_viewport &= (
+                    (x < clip[:, 2]) & (x + width >= clip[:, 0]) & (y < clip[:, 3]) & (y + height >= clip[:, 1])
+            )
+        survivors = np.flatnonzero(self.has_layout & ~self.is_black_listed & partially_is_in_viewport)
+
+        x = x[survivors]
+        y = y[survivors]
+        return (
+            survivors,
+            np.trunc(x).astype(np.int64),
+            np.trunc(y).astype(np.int64),
+            np.trunc(x + width[survivors] / 2).astype(np.int64),
+            np.trunc(y + height[survivors] / 2).astype(np.int64),
+        )
+
+
+def render_snapshot(snapshot, device_pixel_ratio, win_left_bound, win_upper_bound, win_right_bound, win_lower_bound,
+                    page_element_buffer, full_page=False, scroll_delta=(0, 0)):
+    # With full_page, every element of the document is kept instead of just those in the window. Either way each
+    # element is tagged with scroll_y, the vertical scroll offset that brings it to the middle of the window.
+    with tracer.span("crawl.filter", nodes=snapshot.node_count) as span:
+        if full_page:
+            survivors, origins_x, origins_y, centers_x, centers_y = snapshot.cull(
+                device_pixel_ratio, -np.inf, -np.inf, np.inf, np.inf, scroll_delta
+            )
+        else:
+            survivors, origins_x, origins_y, centers_x, centers_y = snapshot.cull(
+                device_pixel_ratio, win_left_bound, win_upper_bound, win_right_bound, win_lower_bound, scroll_delta
+            )
+        span.set(survivors=len(survivors))
+    tracer.count("nodes", snapshot.node_count)
+    tracer.count("survivors", len(survivors))
+
+    with tracer.span("crawl.render") as span:
+        elements_of_interest = render_survivors(
+            snapshot, survivors, origins_x, origins_y, centers_x, centers_y, (win_lower_bound - win_upper_bound) // 2,
+            page_element_buffer
+        )
+        span.set(elements=len(elements_of_interest))
+    tracer.count("elements", len(elements_of_interest))
+    return elements_of_interest
+
+
+def render_survivors(snapshot, survivors, origins_x, origins_y, centers_x, centers_y, half_height, page_element_buffer):
+    strings = snapshot.strings
+    lower_names = snapshot.lower_names
+    node_value = snapshot.node_value
+    backend_node_id = snapshot.backend_node_id
+    attributes = snapshot.attributes
+    attribute_key_ids = snapshot.attribute_key_ids
+    input_value_of = snapshot.input_value_of
+    is_clickable = snapshot.is_clickable
+
+    child_nodes = {}
+    elements_in_view_port = []
+
+    for index, node_name_index, anchor_id, button_id, origin_x, origin_y, center_x, center_y, clickable in zip(
+            survivors.tolist(),
+            snapshot.node_names[survivors].tolist(),
+            snapshot.anchor_ancestor[survivors].tolist(),
+            snapshot.button_ancestor[survivors].tolist(),
+            origins_x.tolist(),
+            origins_y.tolist(),
+            centers_x.tolist(),
+            centers_y.tolist(),
+            is_clickable[survivors].tolist(),
+    ):
+        node_name = lower_names[node_name_index]
+        is_ancestor_of_anchor = anchor_id >= 0
+        is_ancestor_of_button = button_id >= 0
+
+        meta_data = []
+
+        # no wanted key in the string table means no node has any of the attributes
+        element_attributes = (
+            find_attributes(attributes[index], attribute_key_ids, strings)
+            if attribute_key_ids and attributes[index] else {}
+        )
+
+        ancestor_exception = is_ancestor_of_anchor or is_ancestor_of_button
+        # entries are (attribute key, value), with a key of None for text
+        ancestor_node = (
+            None
+            if not ancestor_exception
+            else child_nodes.setdefault(anchor_id if is_ancestor_of_anchor else button_id, [])
+        )
+
+        if node_name == "#text" and ancestor_exception:
+            text = strings[node_value[index]]
+            if text == "|" or text == "•":
+                continue
+            ancestor_node.append((None, text))
+        else:
+            if (
+                    node_name == "input" and element_attributes.get("type") == "submit"
+            ) or node_name == "button":
+                node_name = "button"
+                element_attributes.pop(
+                    "type", None
+                )  # prevent [button ... (button)..]
+
+            for key in element_attributes:
+                if ancestor_exception:
+                    ancestor_node.append((key, element_attributes[key]))
+                else:
+                    meta_data.append(element_attributes[key])
+
+        element_node_value = None
+
+        if node_value[index] >= 0:
+            element_node_value = strings[node_value[index]]
+            if element_node_value == "|":  # commonly used as a seperator, does not add much context - lets save ourselves some token space
+                continue
+        elif node_name == "input":
+            text_index = input_value_of.get(index, -1)
+            if text_index >= 0:
+                element_node_value = strings[text_index]
+
+        # remove redudant elements
+        if ancestor_exception and (node_name != "a" and node_name != "button"):
+            continue
+
+        elements_in_view_port.append(Element(
+            index, backend_node_id[index], None, node_name, element_node_value, meta_data, clickable,
+            origin_x, origin_y, center_x, center_y, max(0, center_y - half_height),
+        ))
+
+    return render_elements(elements_in_view_port, child_nodes, page_element_buffer)
+
+
+def render_elements(elements_in_view_port, child_nodes, page_element_buffer):
+    # lets filter further to remove anything that does not hold any text nor has click handlers + merge text from leaf#text nodes with the parent
+    elements_of_interest = []
+    id_counter = 0
+
+    for element in elements_in_view_port:
+        node_index = element.node_index
+        node_name = element.node_name
+        node_value = element.node_value
+        is_clickable = element.is_clickable
+        meta_data = element.node_meta
+
+        inner_text = f"{node_value} " if node_value else ""
+        meta = ""
+
+        if node_index in child_nodes:
+            for entry_key, entry_value in child_nodes[node_index]:
+                if entry_key is not None:
+                    meta_data.append(f'{entry_key}="{entry_value}"')
+                else:
+                    inner_text += f"{entry_value} "
+
+        if meta_data:
+            meta_string = " ".join(meta_data)
+            meta = f" {meta_string}"
+
+        if inner_text != "":
+            inner_text = f"{inner_text.strip()}"
+
+        converted_node_name = convert_name(node_name, is_clickable)
+
+        # not very elegant, more like a placeholder
+        if (
+                (converted_node_name != "button" or meta == "")
+                and converted_node_name != "link"
+                and converted_node_name != "input"
+                and converted_node_name != "img"
+                and converted_node_name != "textarea"
+        ) and inner_text.strip() == "":
+            continue
+
+        page_element_buffer[id_counter] = element
+
+        if inner_text != "":
+            elements_of_interest.append(
+                f"""<{converted_node_name} id={id_counter}{meta}>{inner_text}</{converted_node_name}>"""
+            )
+        else:
+            elements_of_interest.append(
+                f"""<{converted_node_name} id={id_counter}{meta}/>"""
+            )
+        id_counter += 1
+
+
+    return elements_of_interest
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# stub_server.py
+#
+# A local stand-in for the OpenAI completions endpoint, so the whole agent loop can be benchmarked offline:
+#
+#   python stub_server.py --port 8765 --latency 0.8
+#   NATBOT_LLM_URL=http://127.0.0.1:8765/v1 python batch.py objectives.jsonl
+#
+# Responses are deterministic: either the lines of --responses in turn, or a command derived from the browser
+# content in the prompt (type into the first input, else click the first link, else scroll down). Requests with
+# "stream": true get the completion as server-sent events, one token per event, --per-token-latency apart.
+#
+
+import argparse
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+content_header = "CURRENT BROWSER CONTENT:"
+input_pattern = re.compile(r"<input id=(\d+)")
+link_pattern = re.compile(r"<link id=(\d+)")
+token_pattern = re.compile(r"\w+|[^\w\s]")
+# the text split into tokens that add up to it again, whitespace going with the token after it
+stream_token_pattern = re.compile(r"\s*(?:\w+|[^\w\s])|\s+")
+
+
+def command_for(prompt):
+    content = prompt[prompt.rfind(content_header):]
+    input_match = input_pattern.search(content)
+    if input_match:
+        return f'TYPESUBMIT {input_match.group(1)} "natbot"'
+    link_match = link_pattern.search(content)
+    if link_match:
+        return f"CLICK {link_match.group(1)}"
+    return "SCROLL DOWN"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        prompt = request.get("prompt", "")
+        server = self.server
+
+        if server.responses is not None:
+            with server.lock:
+                text = next(server.responses)
+        else:
+            text = command_for(prompt)
+        text = " " + text + "\n"
+
+        # pretend to keep a prefix cache: whatever this prompt shares with the previous one counts as cached
+        with server.lock:
+            cached_prefix = os.path.commonprefix([server.previous_prompt, prompt])
+            server.previous_prompt = prompt
+
+        prompt_tokens = len(token_pattern.findall(prompt))
+        completion_tokens = len(token_pattern.findall(text))
+        n = request.get("n", 1)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens * n,
+            "total_tokens": prompt_tokens + completion_tokens * n,
+            "prompt_tokens_details": {"cached_tokens": len(token_pattern.findall(cached_prefix))},
+        }
+        if request.get("stream"):
+            self.stream(request, text, n, usage)
+            return
+
+        time.sleep(server.latency + server.per_token_latency * completion_tokens)
+        body = json.dumps({
+            "id": "cmpl-stub",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"text": text, "index": index, "finish_reason": "stop"} for index in range(n)],
+            "usage": usage,
+        }).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, data):
+        event = b"data: " + data + b"\n\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+        self.wfile.flush()
+
+    def stream(self, request, text, n, usage):
+        server = self.server
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(server.latency)
+        tokens = stream_token_pattern.findall(text)
+        chunk = {"id": "cmpl-stub", "object": "text_completion", "model": request.get("model", "stub")}
+        try:
+            for position, token in enumerate(tokens):
+                time.sleep(server.per_token_latency)
+                last = position == len(tokens) - 1
+                for index in range(n):
+                    choice = {"text": token, "index": index, "finish_reason": "stop" if last else None}
+                    self.send_event(json.dumps(dict(chunk, choices=[choice])).encode())
+            self.send_event(json.dumps(dict(chunk, choices=[], usage=usage)).encode())
+            self.send_event(b"[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client has heard enough
+            with server.lock:
+                server.cancelled += 1
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(host="127.0.0.1", port=8765, latency=0.0, per_token_latency=0.0, responses=None, verbose=False):
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.per_token_latency = per_token_latency
+    server.responses = itertools.cycle(responses) if responses else None
+    server.lock = threading.Lock()
+    server.previous_prompt = ""
+    # streamed requests the client hung up on
+    server.cancelled = 0
+    server.verbose = verbose
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every response")
+    parser.add_argument("--per-token-latency", type=float, default=0.0, help="extra seconds per completion token")
+    parser.add_argument("--responses", help="file of completions to return in turn, one per line")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    responses = None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = [line.rstrip("\n") for line in f if line.strip()]
+
+    server = make_server(args.host, args.port, args.latency, args.per_token_latency, responses, args.verbose)
+    print(f"Serving stub completions on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,142 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+def current_track():
+    # spans of one asyncio task or, outside of the event loop, of one thread nest and end up on one track
+    # asyncio.current_task raises outside of a loop, which costs more than the rest of a span
+    task = asyncio.current_task() if asyncio._get_running_loop() is not None else None
+    if task is not None:
+        return id(task), task.get_name()
+    thread = threading.current_thread()
+    return thread.ident, thread.name
+
+
+class Span:
+    __slots__ = ("tracer", "name", "attributes", "start")
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.events.append(
+            ("span", self.name, self.start, time.perf_counter_ns() - self.start, current_track(), self.attributes)
+        )
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Tracer:
+    # Records spans and counters in a bounded in-memory buffer: one tuple per event, appended without a lock (deque
+    # appends are atomic), and nothing is formatted until export. Cheap enough to stay on; the oldest events are
+    # dropped beyond max_events.
+    def __init__(self, enabled=True, max_events=200000):
+        self.enabled = enabled
+        self.events = deque(maxlen=max_events)
+        self.epoch = time.perf_counter_ns()
+
+    def span(self, name, **attributes):
+        # with tracer.span("crawl.capture", frames=2) as span: ...; span.set(...) adds attributes on the way
+        if not self.enabled:
+            return null_span
+        return Span(self, name, attributes)
+
+    def count(self, name, value, **attributes):
+        if self.enabled:
+            self.events.append(("counter", name, time.perf_counter_ns(), value, current_track(), attributes))
+
+    def clear(self):
+        self.events.clear()
+
+    def records(self):
+        # the events as dicts, with times in seconds since the tracer was created
+        for kind, name, start, value, (track, track_name), attributes in list(self.events):
+            record = {"type": kind, "name": name, "start": (start - self.epoch) / 1e9, "track": track_name}
+            if kind == "span":
+                record["duration"] = value / 1e9
+            else:
+                record["value"] = value
+            if attributes:
+                record["attributes"] = attributes
+            yield record
+
+    def summary(self):
+        # {span name: (count, total seconds)}
+        totals = {}
+        for kind, name, start, value, track, attributes in list(self.events):
+            if kind == "span":
+                count, total = totals.get(name, (0, 0))
+                totals[name] = (count + 1, total + value / 1e9)
+        return totals
+
+    def export_jsonl(self, path):
+        with open(path, "w") as f:
+            for record in self.records():
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def export_chrome(self, path):
+        # the trace event format read by chrome://tracing and Perfetto
+        pid = os.getpid()
+        trace_events = []
+        track_names = {}
+        for kind, name, start, value, (track, track_name), attributes in list(self.events):
+            track_names[track] = track_name
+            timestamp = (start - self.epoch) / 1e3
+            if kind == "span":
+                trace_events.append({
+                    "name": name, "ph": "X", "ts": timestamp, "dur": value / 1e3, "pid": pid, "tid": track,
+                    "args": attributes,
+                })
+            else:
+                trace_events.append({
+                    "name": name, "ph": "C", "ts": timestamp, "pid": pid, "tid": track, "args": {name: value},
+                })
+        for track, track_name in track_names.items():
+            trace_events.append({
+                "name": "thread_name", "ph": "M", "pid": pid, "tid": track, "args": {"name": track_name},
+            })
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f, default=str)
+
+    def export(self, path):
+        # JSON lines for .jsonl files, the Chrome trace event format for anything else
+        if path.endswith(".jsonl"):
+            self.export_jsonl(path)
+        else:
+            self.export_chrome(path)
+
+
+# the process-wide tracer; set NATBOT_TRACE to a file path to have it written there on exit, and NATBOT_TRACE=off to
+# turn tracing off
+tracer = Tracer(enabled=os.environ.get("NATBOT_TRACE", "").lower() != "off")
+if os.environ.get("NATBOT_TRACE", "").lower() not in ("", "off"):
+    atexit.register(tracer.export, os.environ["NATBOT_TRACE"])